@@ -1,13 +1,16 @@
 import argparse
 import asyncio
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from sqlalchemy.orm import Session
 
 from models import get_db_engine
+from models.interaction import resolve_follow_edges
 from models.job import Job, JobSource, Worker
-from models.job import insert_jobs_on_conflict_ignore, new_job_id
+from models.job import archive_finished_crawls, create_crawl, insert_jobs_on_conflict_ignore, new_job_id, notify_new_jobs
 from runner import unauthenticated, authenticated
+from runner.freshness import DEFAULT_FRESHNESS_TTL
+from vendor.scweet.utils import DEFAULT_JITTER
 
 
 def start_scraper(
@@ -15,18 +18,27 @@ def start_scraper(
         auth_concurrency: int,
         auth_cooldown: int,
         anon_cooldown: Optional[int],
-        chrome_data_basedir: str
+        chrome_data_basedir: str,
+        freshness_ttl: Optional[int],
+        auth_jitter: Tuple[float, float],
+        auth_max_jobs: int,
+        lean_browser: bool,
     ):
     async def run():
         await asyncio.gather(
             authenticated.run(
                 concurrency=auth_concurrency,
                 worker_cooldown=auth_cooldown,
-                chrome_data_basedir=chrome_data_basedir
+                chrome_data_basedir=chrome_data_basedir,
+                freshness_ttl=freshness_ttl,
+                jitter=auth_jitter,
+                worker_max_jobs=auth_max_jobs,
+                lean_browser=lean_browser,
             ),
             unauthenticated.run(
                 concurrency=anon_concurrency,
-                cooldown=anon_cooldown
+                cooldown=anon_cooldown,
+                freshness_ttl=freshness_ttl,
             ),
         )
 
@@ -45,11 +57,19 @@ def add_worker(twitter_username: str, twitter_password: str):
         session.commit()
 
 
-def submit_job(usernames: List[str], max_followers: int, max_depth: int, max_tweets: int):
+def submit_job(
+        usernames: List[str],
+        max_followers: int,
+        max_depth: int,
+        max_tweets: int,
+        weight: float = 1,
+        max_accounts: Optional[int] = None,
+):
     engine = get_db_engine()
     with Session(engine) as session:
         for username in usernames:
             job_id = new_job_id(username)
+            create_crawl(session, job_id, weight=weight, max_accounts=max_accounts)
             session.execute(
                 insert_jobs_on_conflict_ignore(
                     Job(
@@ -74,10 +94,32 @@ def submit_job(usernames: List[str], max_followers: int, max_depth: int, max_twe
                     )
                 )
             )
+            notify_new_jobs(session)
             session.commit()
             print(f'Submitted job {job_id}')
 
 
+def migrate():
+    get_db_engine(init=True)
+    print('Database is up to date')
+
+
+def archive_jobs():
+    engine = get_db_engine()
+    with Session(engine) as session:
+        n_archived = archive_finished_crawls(session)
+        session.commit()
+        print(f'Archived {n_archived} jobs')
+
+
+def resolve_follows():
+    engine = get_db_engine()
+    with Session(engine) as session:
+        n_resolved = resolve_follow_edges(session)
+        session.commit()
+        print(f'Added {n_resolved} follow edges')
+
+
 def main():
     parser = argparse.ArgumentParser('scraper admin CLI')
     subparsers = parser.add_subparsers(dest='command')
@@ -90,10 +132,18 @@ def main():
         '--max-authenticated', type=int, help='Max concurrenct authenticated jobs', default=1)
     start_parser.add_argument(
         '--authenticated-worker-cooldown', type=int, help='Cooldown for authenticated workers (seconds)', default=60*60*8)
+    start_parser.add_argument(
+        '--authenticated-worker-max-jobs', type=int, help='Jobs an authenticated worker runs before its cooldown (give or take a couple)', default=5)
     start_parser.add_argument(
         '--anonymous-worker-cooldown', type=int, help='Cooldown for anonymous workers (seconds)', default=None)
     start_parser.add_argument(
         '--chrome-data-basedir', type=str, help='Where to store chrome data', default='.scraper-chrome-data')
+    start_parser.add_argument(
+        '--authenticated-jitter', type=float, nargs=2, metavar=('MIN', 'MAX'), help='Pause between browser actions (seconds)', default=DEFAULT_JITTER)
+    start_parser.add_argument(
+        '--lean-browser', action='store_true', help="Don't load images, media and fonts in chrome, and turn off extensions, sync and background networking")
+    start_parser.add_argument(
+        '--freshness-ttl', type=int, help='Reuse stored data for accounts scraped less than this long ago (seconds, 0 to disable)', default=DEFAULT_FRESHNESS_TTL)
 
     add_worker_parser = subparsers.add_parser(
         'add-worker', help='Add a scraper worker')
@@ -111,7 +161,20 @@ def main():
     submit_job_parser.add_argument(
         '--max-tweets', type=int, help='Max tweets per account', default=600)
     submit_job_parser.add_argument(
-        '--max-followers', type=int, help='Max followers per account', default=200)
+        '--max-followers', type=int, help='Max following and followers per account', default=200)
+    submit_job_parser.add_argument(
+        '--weight', type=float, help='Share of workers relative to other crawls', default=1)
+    submit_job_parser.add_argument(
+        '--max-accounts', type=int, help='Max accounts in the whole crawl (default: no limit)', default=None)
+
+    subparsers.add_parser(
+        'migrate', help='Create missing tables and apply schema migrations')
+
+    subparsers.add_parser(
+        'archive-jobs', help='Move jobs of finished crawls out of the live queue')
+
+    subparsers.add_parser(
+        'resolve-follows', help='Add follow graph edges for follows scraped by username only')
 
     args = parser.parse_args()
 
@@ -122,16 +185,30 @@ def main():
             auth_cooldown=args.authenticated_worker_cooldown,
             anon_cooldown=args.anonymous_worker_cooldown,
             chrome_data_basedir=args.chrome_data_basedir,
+            freshness_ttl=args.freshness_ttl,
+            auth_jitter=tuple(args.authenticated_jitter),
+            auth_max_jobs=args.authenticated_worker_max_jobs,
+            lean_browser=args.lean_browser,
         )
     elif args.command == 'add-worker':
         add_worker(args.username, args.password)
     elif args.command == 'submit-job':
+        if args.weight <= 0:
+            parser.error('--weight must be positive')
         submit_job(
             usernames=args.usernames,
             max_followers=args.max_followers,
             max_tweets=args.max_tweets,
-            max_depth=args.max_depth
+            max_depth=args.max_depth,
+            weight=args.weight,
+            max_accounts=args.max_accounts,
         )
+    elif args.command == 'migrate':
+        migrate()
+    elif args.command == 'archive-jobs':
+        archive_jobs()
+    elif args.command == 'resolve-follows':
+        resolve_follows()
     else:
         parser.print_help()
 
@@ -0,0 +1,38 @@
+import os
+from typing import Optional
+
+
+def _rss(pid: int) -> int:
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _children(pid: int):
+    for tid in os.listdir(f'/proc/{pid}/task'):
+        with open(f'/proc/{pid}/task/{tid}/children') as f:
+            yield from (int(child) for child in f.read().split())
+
+
+def process_tree_rss(pid: int) -> Optional[int]:
+    '''
+    Resident memory (bytes) of a process and all of its descendants, e.g.
+    chromedriver plus chrome and its renderers. None where /proc isn't
+    available.
+    '''
+    if not os.path.exists(f'/proc/{pid}/status'):
+        return None
+
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            total += _rss(current)
+            pending.extend(_children(current))
+        except (FileNotFoundError, ProcessLookupError):
+            # exited while we were looking
+            continue
+    return total
@@ -4,23 +4,54 @@
 import asyncio
 import os
 
+from typing import Optional
+
 from common.logging import logger
+from models import shared_db_engine, uses_external_pool
 from runner import unauthenticated
+from runner.deadline import Deadline, JobDurations
+from runner.freshness import DEFAULT_FRESHNESS_TTL
 
 
 SCRAPER_CONCURRENCY = int(os.environ.get('SCRAPER_CONCURRENCY', '2'))
+# 0 for as many as fit before the timeout
 SCRAPER_MAX_JOBS = int(os.environ.get('SCRAPER_MAX_JOBS', '8'))
+SCRAPER_LEASE_BATCH_SIZE = int(
+    os.environ.get('SCRAPER_LEASE_BATCH_SIZE', str(SCRAPER_CONCURRENCY)))
+# seconds, 0 to disable
+SCRAPER_FRESHNESS_TTL = int(
+    os.environ.get('SCRAPER_FRESHNESS_TTL', str(DEFAULT_FRESHNESS_TTL)))
+# stop this many seconds before the lambda timeout so leases can be released
+SCRAPER_TIMEOUT_MARGIN = int(os.environ.get('SCRAPER_TIMEOUT_MARGIN', '10'))
+
+# kept across warm invocations
+job_durations = JobDurations()
 
 
-async def run():
+async def run(deadline: Optional[Deadline] = None):
     logger.info(
         f'LAMBDA: starting with concurrency {SCRAPER_CONCURRENCY}, max jobs {SCRAPER_MAX_JOBS}')
 
+    # the engine (and its pooled connections) and the guest sessions of
+    # scrapers.guest live at module scope, so warm invocations reuse them. The
+    # schema isn't checked here, run `admin.py migrate` on deploy
     return await unauthenticated.run(
         concurrency=SCRAPER_CONCURRENCY,
-        max_jobs=SCRAPER_MAX_JOBS
+        max_jobs=SCRAPER_MAX_JOBS or None,
+        batch_size=SCRAPER_LEASE_BATCH_SIZE,
+        freshness_ttl=SCRAPER_FRESHNESS_TTL,
+        engine=shared_db_engine(),
+        listen=not uses_external_pool(),
+        deadline=deadline,
     )
 
 
-def handler(_event, _context):
-    return asyncio.run(run())
+def handler(_event, context):
+    deadline = None
+    if context is not None:
+        deadline = Deadline(
+            context.get_remaining_time_in_millis() / 1000 - SCRAPER_TIMEOUT_MARGIN,
+            job_durations,
+        )
+
+    return asyncio.run(run(deadline))
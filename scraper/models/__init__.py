@@ -1,16 +1,36 @@
+from functools import lru_cache
+from os import environ as env
+
 from sqlalchemy import URL, Engine, create_engine
+from sqlalchemy.pool import NullPool
 
 from .base import Base, ScrapeBase
 
 
 def init_db(engine: Engine):
+    # importing the models registers their tables
+    from . import account, interaction, job, ratelimit  # noqa: F401
+    from .migrations import migrate
+
     Base.metadata.create_all(engine)
     ScrapeBase.metadata.create_all(engine)
+    migrate(engine)
+
 
+def uses_external_pool() -> bool:
+    '''
+    Whether connections go through an external pooler (pgbouncer, RDS proxy),
+    set with SCRAPER_PG_POOL=external. Assumes transaction pooling, so
+    session state like LISTEN can't be relied on.
+    '''
+    return env.get('SCRAPER_PG_POOL') == 'external'
 
-def get_db_engine(echo: bool = False) -> Engine:
-    from os import environ as env
 
+def get_db_engine(echo: bool = False, init: bool = False) -> Engine:
+    '''
+    :init create missing tables and run migrations. Only the migrate command
+        does this, everything else assumes the schema is up to date.
+    '''
     url = URL.create(
         drivername='postgresql',
         username=env.get('SCRAPER_PG_USER'),
@@ -20,8 +40,26 @@ def get_db_engine(echo: bool = False) -> Engine:
         port=env.get('SCRAPER_PG_PORT')
     )
 
-    engine = create_engine(url, echo=echo)
+    if uses_external_pool():
+        # the pooler holds the connections, so don't keep any open here
+        engine = create_engine(url, echo=echo, poolclass=NullPool)
+    else:
+        engine = create_engine(
+            url,
+            echo=echo,
+            pool_size=int(env.get('SCRAPER_PG_POOL_SIZE', '5')),
+            # pooled connections may have been dropped while idle (e.g. a
+            # frozen lambda container)
+            pool_pre_ping=True,
+        )
 
-    init_db(engine)
+    if init:
+        init_db(engine)
 
     return engine
+
+
+@lru_cache(maxsize=None)
+def shared_db_engine() -> Engine:
+    '''One engine per process, e.g. reused across warm lambda invocations.'''
+    return get_db_engine()
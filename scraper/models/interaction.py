@@ -1,10 +1,16 @@
+from __future__ import annotations
+
 import datetime
 
-from typing import Optional
+from typing import Dict, Iterable, Optional
 
+from sqlalchemy import BigInteger, Index, cast, func, literal_column, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session, aliased
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import Mapped
 
+from models.account import Account
 from models.base import ScrapeBase
 
 
@@ -17,21 +23,59 @@ class Favorite(ScrapeBase):
     liked_by_rest_id: Mapped[str]
     tweet_rest_id: Mapped[str]  # = mapped_column(ForeignKey('tweet.rest_id'),)
 
+    __table_args__ = (
+        # natural key, so re-scrapes upsert. Also covers likes-by lookups
+        Index('favorite_uniqueness', 'liked_by_rest_id', 'tweet_rest_id', unique=True),
+        Index('favorite_tweet_idx', 'tweet_rest_id'),
+    )
+
 
 class Follow(ScrapeBase):
+    '''Follows as scraped, by username. See FollowEdge for the graph.'''
     __tablename__ = 'follow'
 
     internal_id: Mapped[int] = mapped_column(
         primary_key=True, autoincrement=True)
-    # TODO: it's possible to get this data as we scrape followers (just need to
-    # do concurrently or something) it is possible to use the rest id columns
     follows_username: Mapped[str]
     followed_by_username: Mapped[str]
 
-    # follows_rest_id: Mapped[str] = mapped_column(
-    #     ForeignKey('account.rest_id'),)
-    # followed_by_rest_id: Mapped[str] = mapped_column(
-    #     ForeignKey('account.rest_id'),)
+    # when known at scrape time (not a foreign key, the account may not have
+    # been scraped). A re-scrape without them doesn't erase them
+    follows_rest_id: Mapped[Optional[int]] = mapped_column(
+        BigInteger, info={'keep_if_null': True})
+    followed_by_rest_id: Mapped[Optional[int]] = mapped_column(
+        BigInteger, info={'keep_if_null': True})
+
+    __table_args__ = (
+        # natural key, so re-scrapes upsert. Also covers following-of lookups
+        Index('follow_uniqueness', 'followed_by_username', 'follows_username', unique=True),
+        Index('follow_follows_idx', 'follows_username'),
+    )
+
+    def edge(self) -> Optional[FollowEdge]:
+        if self.follows_rest_id is None or self.followed_by_rest_id is None:
+            return None
+        return FollowEdge(
+            follows_rest_id=self.follows_rest_id,
+            followed_by_rest_id=self.followed_by_rest_id,
+        )
+
+
+class FollowEdge(ScrapeBase):
+    '''
+    The follow graph, keyed by rest_id. Unique per edge, so re-crawls upsert,
+    and indexed both ways for followers-of and following-of lookups.
+    '''
+    __tablename__ = 'follow_edge'
+
+    # the primary key doubles as the "who does X follow" index
+    followed_by_rest_id: Mapped[int] = mapped_column(
+        BigInteger, primary_key=True)
+    follows_rest_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+
+    __table_args__ = (
+        Index('follow_edge_follows_idx', 'follows_rest_id', 'followed_by_rest_id'),
+    )
 
 
 class Tweet(ScrapeBase):
@@ -61,6 +105,12 @@ class Tweet(ScrapeBase):
     # = mapped_column(ForeignKey('tweet.rest_id'))
     reply_to_tweet_rest_id: Mapped[Optional[str]]
 
+    __table_args__ = (
+        # an account's tweets, newest first
+        Index('tweet_author_idx', 'author_rest_id', 'created_on'),
+        Index('tweet_reply_to_account_idx', 'reply_to_account_rest_id'),
+    )
+
     # tw_is_possibly_sensitive: Mapped[bool]
     # tw_vibe: Mapped[str]
     # tw_is_quoted: Mapped[str]
@@ -82,3 +132,43 @@ class Tweet(ScrapeBase):
     # reply_to: Mapped[Optional[str]]
     # threads: Mapped[str]
     # comments: Mapped[str]
+
+
+def resolve_rest_ids(session: Session, usernames: Iterable[str]) -> Dict[str, int]:
+    '''rest_ids of already scraped accounts, by username.'''
+    return {
+        username: int(rest_id)
+        for username, rest_id in session.execute(
+            select(Account.username, Account.rest_id)
+            .filter(Account.username.in_(list(usernames)))
+        )
+    }
+
+
+def resolve_follow_edges(session: Session) -> int:
+    '''
+    Add graph edges for scraped follows, filling in rest_ids that weren't
+    known at scrape time from scraped accounts. Follows whose accounts haven't
+    been scraped yet are left for a later run. Caller must commit.
+    '''
+    follows_account = aliased(Account)
+    followed_by_account = aliased(Account)
+    follows_rest_id = func.coalesce(
+        Follow.follows_rest_id, cast(follows_account.rest_id, BigInteger))
+    followed_by_rest_id = func.coalesce(
+        Follow.followed_by_rest_id, cast(followed_by_account.rest_id, BigInteger))
+
+    edges = (
+        select(followed_by_rest_id, follows_rest_id, literal_column('now()'))
+        .select_from(Follow)
+        .outerjoin(follows_account, follows_account.username == Follow.follows_username)
+        .outerjoin(followed_by_account, followed_by_account.username == Follow.followed_by_username)
+        .filter(follows_rest_id != None, followed_by_rest_id != None)
+        .distinct()
+    )
+    result = session.execute(
+        pg_insert(FollowEdge)
+        .from_select(['followed_by_rest_id', 'follows_rest_id', 'scraped_at'], edges)
+        .on_conflict_do_nothing()
+    )
+    return result.rowcount
@@ -3,12 +3,14 @@ from __future__ import annotations
 import datetime
 
 from enum import Enum
-from typing import Optional
-from sqlalchemy import UniqueConstraint
+from typing import Any, Dict, Optional
+from sqlalchemy import CheckConstraint, Index, UniqueConstraint, delete, insert, select, update
 
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import Mapped
+from sqlalchemy.orm import Session
 from sqlalchemy.sql import func
 
 from models.base import Base
@@ -25,6 +27,7 @@ class JobSource(Enum):
     MANUAL = 'manual'
     TWEET_REPLY = 'reply'
     FOLLOWING = 'following'
+    FOLLOWER = 'follower'
 
 
 class JobType(Enum):
@@ -33,6 +36,10 @@ class JobType(Enum):
     TWEETS = 'tweets'
 
 
+# postgres LISTEN/NOTIFY channel used to wake up idle workers
+NEW_JOB_CHANNEL = 'new_job'
+
+
 def new_job_id(root_username: str):
     return f'{root_username}-{int(datetime.datetime.now().timestamp())}'
 
@@ -46,21 +53,19 @@ class Worker(Base):
     proxy: Mapped[Optional[str]]
 
     last_active: Mapped[Optional[datetime.datetime]]
+    # jobs run since the account last rested, and how many it gets before it
+    # has to (picked at random every time it rests)
+    jobs_since_rest: Mapped[int] = mapped_column(default=0, server_default='0')
+    job_budget: Mapped[Optional[int]]
+    # set while a runner is using the account, in case the runner dies
+    leased_until: Mapped[Optional[datetime.datetime]]
 
     __table_args__ = (UniqueConstraint(
         'twitter_username', name='worker_uniqueness'),)
 
 
-class Job(Base):
-    __tablename__ = 'job'
-
-    __table_args__ = (UniqueConstraint('job_id', 'username',
-                      'is_authenticated', name='job_uniqueness'),)
-
-    # makes things easier to have a single unique ID to refer to
-    internal_id: Mapped[int] = mapped_column(
-        primary_key=True, autoincrement=True)
-
+class JobFields:
+    '''Columns shared by the live job queue and its archive.'''
     source: Mapped[JobSource]
 
     job_id: Mapped[str]
@@ -69,6 +74,13 @@ class Job(Base):
 
     status: Mapped[JobStatus] = mapped_column(default=JobStatus.NEW)
     created_at: Mapped[datetime.datetime] = mapped_column(default=func.now())
+    # of the last run (UTC)
+    started_at: Mapped[Optional[datetime.datetime]]
+    finished_at: Mapped[Optional[datetime.datetime]]
+    # times the job was put back in the queue after a failed run
+    retry_count: Mapped[int] = mapped_column(default=0, server_default='0')
+    # higher goes first within its crawl (see runner.frontier)
+    priority: Mapped[float] = mapped_column(default=0, server_default='0')
 
     # 0 if this is the root
     own_depth: Mapped[int]
@@ -77,6 +89,94 @@ class Job(Base):
     max_followers: Mapped[int]
 
 
+class Job(JobFields, Base):
+    __tablename__ = 'job'
+
+    __table_args__ = (UniqueConstraint('job_id', 'username',
+                      'is_authenticated', name='job_uniqueness'),)
+
+    # makes things easier to have a single unique ID to refer to
+    internal_id: Mapped[int] = mapped_column(
+        primary_key=True, autoincrement=True)
+
+    # while RUNNING: who's running it, and until when unless they renew (see
+    # runner.lease)
+    worker_id: Mapped[Optional[str]]
+    lease_expires_at: Mapped[Optional[datetime.datetime]]
+    # don't claim before this (backoff after a failed run)
+    next_attempt_at: Mapped[Optional[datetime.datetime]]
+    # progress of an unfinished run, to resume from (see scrapers.checkpoint)
+    checkpoint: Mapped[Optional[Dict[str, Any]]] = mapped_column(JSONB)
+
+
+# matches the per-crawl lookup in runner.base.claim_jobs. Only NEW rows are
+# indexed, so claiming stays an index scan however much history piles up
+job_frontier_index = Index(
+    'job_frontier_idx',
+    Job.job_id,
+    Job.is_authenticated,
+    Job.priority.desc(),
+    Job.own_depth,
+    Job.created_at.desc(),
+    postgresql_where=Job.status == JobStatus.NEW,
+)
+
+# finds expired leases for runner.lease.reap_expired_leases
+job_lease_index = Index(
+    'job_lease_idx',
+    Job.lease_expires_at,
+    postgresql_where=Job.status == JobStatus.RUNNING,
+)
+
+
+class Crawl(Base):
+    '''
+    Scheduling state of a crawl (all jobs sharing a job_id). Crawls share
+    workers in proportion to their weight: every job claimed advances the
+    crawl's virtual time by 1 / weight, and jobs are claimed from the crawls
+    furthest behind.
+    '''
+    __tablename__ = 'crawl'
+
+    job_id: Mapped[str] = mapped_column(primary_key=True)
+    weight: Mapped[float] = mapped_column(default=1, server_default='1')
+    virtual_time: Mapped[float] = mapped_column(default=0, server_default='0')
+    # stop adding accounts to the crawl after this many (None for no limit)
+    max_accounts: Mapped[Optional[int]]
+    n_accounts: Mapped[int] = mapped_column(default=0, server_default='0')
+    created_at: Mapped[datetime.datetime] = mapped_column(
+        server_default=func.now())
+
+    __table_args__ = (CheckConstraint('weight > 0', name='crawl_weight_positive'),)
+
+
+class JobArchive(JobFields, Base):
+    '''
+    Jobs of finished crawls, moved out of `job` by `archive_finished_crawls` to
+    keep the live queue small.
+    '''
+    __tablename__ = 'job_archive'
+
+    internal_id: Mapped[int] = mapped_column(
+        primary_key=True, autoincrement=False)
+    archived_at: Mapped[datetime.datetime] = mapped_column(
+        server_default=func.now())
+
+
+# find the last complete scrape of an account for runner.freshness, live or
+# archived
+job_finished_index, job_archive_finished_index = [
+    Index(
+        f'{model.__tablename__}_finished_idx',
+        model.username,
+        model.is_authenticated,
+        model.finished_at,
+        postgresql_where=model.status == JobStatus.FINISHED,
+    )
+    for model in (Job, JobArchive)
+]
+
+
 def create_child_job(job: Job, username: str, source: JobSource, authenticated: Optional[bool] = None):
     '''Make a child target with settings copied and depth incremented.
     Caller must save.'''
@@ -94,7 +194,7 @@ def create_child_job(job: Job, username: str, source: JobSource, authenticated:
 
 def insert_jobs_on_conflict_ignore(*following_jobs: Job):
     '''
-    Insert targets, ignore duplicates
+    Insert targets, ignore duplicates. Returns the usernames of inserted jobs.
     '''
     return pg_insert(Job).values([
         dict(
@@ -105,7 +205,105 @@ def insert_jobs_on_conflict_ignore(*following_jobs: Job):
             max_depth=job.max_depth,
             max_tweets=job.max_tweets,
             max_followers=job.max_followers,
-            is_authenticated=job.is_authenticated
+            is_authenticated=job.is_authenticated,
+            priority=job.priority or 0,
         )
         for job in following_jobs
-    ]).on_conflict_do_nothing(index_elements=[Job.job_id, Job.username, Job.is_authenticated])
+    ]).on_conflict_do_nothing(
+        index_elements=[Job.job_id, Job.username, Job.is_authenticated]
+    ).returning(Job.username)
+
+
+def create_crawl(session: Session, job_id: str, weight: float = 1, max_accounts: Optional[int] = None):
+    '''
+    Start scheduling a new crawl level with the ones in progress, so it gets
+    its fair share from now on rather than making up for lost time. Caller
+    must commit.
+    '''
+    in_progress = (
+        select(Job.job_id)
+        .filter(Job.status.in_([JobStatus.NEW, JobStatus.RUNNING]))
+    )
+    virtual_time = session.scalar(
+        select(func.min(Crawl.virtual_time)).filter(Crawl.job_id.in_(in_progress)))
+    session.add(Crawl(
+        job_id=job_id,
+        weight=weight,
+        max_accounts=max_accounts,
+        # the root account
+        n_accounts=1,
+        virtual_time=virtual_time or 0,
+    ))
+
+
+def crawl_budget(session: Session, job_id: str) -> Optional[int]:
+    '''How many more accounts the crawl may add (None for no limit).'''
+    crawl = session.get(Crawl, job_id)
+    if crawl is None or crawl.max_accounts is None:
+        return None
+    return max(crawl.max_accounts - crawl.n_accounts, 0)
+
+
+def count_crawl_accounts(session: Session, job_id: str, n: int):
+    session.execute(
+        update(Crawl)
+        .values(n_accounts=Crawl.n_accounts + n)
+        .where(Crawl.job_id == job_id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def save_checkpoint(session: Session, job: Job, checkpoint: Optional[Dict[str, Any]]):
+    '''Caller must commit.'''
+    session.execute(
+        update(Job)
+        .values(checkpoint=checkpoint)
+        .where(Job.internal_id == job.internal_id)
+        .execution_options(synchronize_session=False)
+    )
+    # keep the job in line with what's stored
+    job.checkpoint = checkpoint
+
+
+def notify_new_jobs(session: Session):
+    '''
+    Wake up workers waiting for jobs. NOTIFY is transactional, so workers are
+    only woken once the caller commits the inserted jobs.
+    '''
+    session.execute(select(func.pg_notify(NEW_JOB_CHANNEL, '')))
+
+
+def archive_finished_crawls(session: Session) -> int:
+    '''
+    Move every job of crawls with nothing left to do (no NEW or RUNNING jobs)
+    into the archive. Whole crawls are moved at once because the live rows are
+    what stops a running crawl from enqueueing the same account twice. Their
+    scheduling rows are deleted, so claiming doesn't keep looking at them.
+    Caller must commit. Returns the number of jobs archived.
+    '''
+    finished_crawls = (
+        select(Job.job_id)
+        .group_by(Job.job_id)
+        .having(func.bool_and(Job.status.in_([JobStatus.FINISHED, JobStatus.ERROR])))
+    )
+    # core tables rather than the ORM entities, the ORM won't nest a DELETE
+    # ... RETURNING inside another statement
+    job, archive = Job.__table__, JobArchive.__table__
+    columns = [column.key for column in job.columns if column.key in archive.c]
+    moved = (
+        delete(job)
+        .where(job.c.job_id.in_(finished_crawls))
+        .returning(*job.columns)
+        .cte('moved')
+    )
+    result = session.execute(
+        insert(archive)
+        .from_select(columns, select(*[moved.c[column] for column in columns]))
+    )
+    # also catches crawls archived before their rows were deleted
+    session.execute(
+        delete(Crawl)
+        .where(~select(Job.job_id).filter(Job.job_id == Crawl.job_id).exists())
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
@@ -0,0 +1,99 @@
+'''
+Schema changes for databases created before the change landed.
+
+`create_all` only creates tables that don't exist yet, so anything added to an
+existing table (columns, indexes) needs an entry here as well as in the model.
+Every migration must be idempotent: they all run on every `init_db`.
+'''
+from typing import List
+
+from sqlalchemy import Engine, Executable, Index, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+
+from models.interaction import Favorite, Follow, Tweet
+from models.job import job_archive_finished_index, job_finished_index, job_frontier_index, job_lease_index
+
+
+def create_index(model, name: str) -> CreateIndex:
+    index = next(index for index in model.__table__.indexes if index.name == name)
+    return CreateIndex(index, if_not_exists=True)
+
+
+def create_unique_index(model, name: str) -> Executable:
+    '''
+    Create a unique index on a table that may already have duplicates, keeping
+    the most recently inserted row of each. Only scans the table once: the
+    whole thing is skipped once the index exists.
+    '''
+    table = model.__table__
+    index: Index = next(index for index in table.indexes if index.name == name)
+    same_key = ' AND '.join(
+        f'a.{column.name} = b.{column.name}' for column in index.columns)
+    ddl = CreateIndex(index).compile(dialect=postgresql.dialect())
+    return text(f'''
+        DO $$ BEGIN
+            IF to_regclass('{name}') IS NULL THEN
+                DELETE FROM {table.name} a USING {table.name} b
+                WHERE {same_key} AND a.internal_id < b.internal_id;
+                {ddl};
+            END IF;
+        END $$
+    ''')
+
+
+MIGRATIONS: List[Executable] = [
+    text('ALTER TABLE follow ADD COLUMN IF NOT EXISTS follows_rest_id BIGINT'),
+    text('ALTER TABLE follow ADD COLUMN IF NOT EXISTS followed_by_rest_id BIGINT'),
+    create_unique_index(Follow, 'follow_uniqueness'),
+    create_index(Follow, 'follow_follows_idx'),
+    create_unique_index(Favorite, 'favorite_uniqueness'),
+    create_index(Favorite, 'favorite_tweet_idx'),
+    create_index(Tweet, 'tweet_author_idx'),
+    create_index(Tweet, 'tweet_reply_to_account_idx'),
+    *[
+        text(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} TIMESTAMP WITHOUT TIME ZONE')
+        for table in ['job', 'job_archive']
+        for column in ['started_at', 'finished_at']
+    ],
+    *[
+        text(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS retry_count INTEGER NOT NULL DEFAULT 0')
+        for table in ['job', 'job_archive']
+    ],
+    text('ALTER TABLE job ADD COLUMN IF NOT EXISTS worker_id VARCHAR'),
+    text('ALTER TABLE job ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP WITHOUT TIME ZONE'),
+    text('ALTER TABLE job ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP WITHOUT TIME ZONE'),
+    CreateIndex(job_lease_index, if_not_exists=True),
+    text('ALTER TABLE worker ADD COLUMN IF NOT EXISTS jobs_since_rest INTEGER NOT NULL DEFAULT 0'),
+    text('ALTER TABLE worker ADD COLUMN IF NOT EXISTS job_budget INTEGER'),
+    text('ALTER TABLE worker ADD COLUMN IF NOT EXISTS leased_until TIMESTAMP WITHOUT TIME ZONE'),
+    # jobs claimed before leases existed would never expire. Give whoever is
+    # running them a while to finish
+    text('''
+        UPDATE job SET lease_expires_at = now() + interval '1 hour'
+        WHERE status = 'RUNNING' AND lease_expires_at IS NULL
+    '''),
+    *[
+        text(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS priority FLOAT NOT NULL DEFAULT 0')
+        for table in ['job', 'job_archive']
+    ],
+    # replaced by job_frontier_idx
+    text('DROP INDEX IF EXISTS job_claim_idx'),
+    CreateIndex(job_frontier_index, if_not_exists=True),
+    # jobs are only claimed through their crawl
+    text('''
+        INSERT INTO crawl (job_id) SELECT DISTINCT job_id FROM job
+        ON CONFLICT DO NOTHING
+    '''),
+    # enums are stored by name
+    text("ALTER TYPE jobsource ADD VALUE IF NOT EXISTS 'FOLLOWER'"),
+    text('ALTER TABLE job ADD COLUMN IF NOT EXISTS checkpoint JSONB'),
+    CreateIndex(job_finished_index, if_not_exists=True),
+    CreateIndex(job_archive_finished_index, if_not_exists=True),
+]
+
+
+def migrate(engine: Engine):
+    with engine.begin() as connection:
+        for migration in MIGRATIONS:
+            connection.execute(migration)
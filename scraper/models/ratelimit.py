@@ -0,0 +1,21 @@
+import datetime
+
+from sqlalchemy.orm import Mapped
+from sqlalchemy.orm import mapped_column
+from sqlalchemy.sql import func
+
+from models.base import Base
+
+
+class RateLimitBucket(Base):
+    '''Token buckets shared by every scraper process, see scrapers.ratelimit.'''
+    __tablename__ = 'rate_limit_bucket'
+
+    # e.g. account:<username>, egress:<proxy>
+    key: Mapped[str] = mapped_column(primary_key=True)
+    # negative when requests were let through on credit, they wait it out
+    tokens: Mapped[float]
+    # tokens per second, adjusted to the rate limits we run into
+    rate: Mapped[float]
+    updated_at: Mapped[datetime.datetime] = mapped_column(
+        server_default=func.now())
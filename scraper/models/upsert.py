@@ -0,0 +1,75 @@
+from typing import Any, Dict, Hashable, List, Optional, Type
+
+from sqlalchemy import Insert, Table
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.sql import func
+
+
+def _is_generated(table: Table, key: str) -> bool:
+    '''Columns the database fills in, which are left out of inserts.'''
+    column = table.c[key]
+    return column.server_default is not None or (
+        column.primary_key and column.autoincrement is True)
+
+
+def conflict_keys(table: Table) -> Optional[List[str]]:
+    '''
+    Columns identifying a row: the primary key, or for tables keyed by an
+    autoincrement ID, their natural key (the first unique index).
+    '''
+    keys = [column.key for column in table.primary_key.columns]
+    if not any(_is_generated(table, key) for key in keys):
+        return keys
+    for index in table.indexes:
+        if index.unique:
+            return [column.key for column in index.columns]
+    return None
+
+
+def row_key(obj: Any) -> Hashable:
+    '''What `upsert` conflicts on for a model instance (or its id if nothing).'''
+    keys = conflict_keys(obj.__table__)
+    if keys is None:
+        return id(obj)
+    return tuple(getattr(obj, key) for key in keys)
+
+
+def row_values(obj: Any) -> Dict[str, Any]:
+    '''Column values of a model instance, as a row for a multi-row insert.'''
+    table: Table = obj.__table__
+    return {
+        column.key: getattr(obj, column.key)
+        for column in table.columns
+        if not _is_generated(table, column.key)
+    }
+
+
+def upsert(model: Type, *objects: Any) -> Insert:
+    '''
+    Insert rows in a single statement, updating rows that already exist (see
+    `conflict_keys`). Tables with no key to conflict on get a plain insert.
+    Rows must have unique keys (see `row_key`).
+
+    Columns with `info={'keep_if_null': True}` keep their stored value when
+    the new row doesn't have one.
+    '''
+    table: Table = model.__table__
+    stmt = pg_insert(table).values([row_values(obj) for obj in objects])
+
+    keys = conflict_keys(table)
+    if keys is None:
+        return stmt
+
+    updates = {
+        column.key: (
+            func.coalesce(stmt.excluded[column.key], column)
+            if column.info.get('keep_if_null') else stmt.excluded[column.key]
+        )
+        for column in table.columns
+        if column.key not in keys and not _is_generated(table, column.key)
+        and not column.primary_key
+    }
+    if 'scraped_at' in table.c:
+        updates['scraped_at'] = func.now()
+
+    return stmt.on_conflict_do_update(index_elements=keys, set_=updates)
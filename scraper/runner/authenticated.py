@@ -5,17 +5,29 @@ Worker initialization:
 import asyncio
 import datetime
 import os
+import random
 
-from sqlalchemy import or_, select, update
+from typing import Optional, Tuple
+
+from sqlalchemy import Engine, case, func, or_, select, update
 from sqlalchemy.orm import Session
 
 from common.logging import logger
 from models import get_db_engine
 from models.job import Job, JobSource, Worker
-from models.job import create_child_job, insert_jobs_on_conflict_ignore
-from runner.base import wrap_scraper_exceptions_and_logging, take_job
+from models.job import create_child_job
+from models.interaction import resolve_rest_ids
+from runner.base import JobNotifier, wrap_scraper_exceptions_and_logging, release_jobs, take_job
+from runner.freshness import DEFAULT_FRESHNESS_TTL, FreshnessPolicy
+from runner.lease import MAX_JOB_DURATION, reap_periodically
+from runner.retry import throttle
+from runner.writer import BufferedWriter
 from scrapers.authenticated import AuthenticatedScraper
+from scrapers.checkpoint import Checkpoint
+from scrapers.drivers import DriverPool, PooledDriver
+from scrapers.ratelimit import rate_limiter
 from vendor.scweet.credentials import Credentials
+from vendor.scweet.utils import DEFAULT_JITTER, init_driver
 
 
 def init_chrome_dirs(basedir: str):
@@ -34,100 +46,268 @@ def get_profile_dir(basedir: str, name: str):
     return os.path.join(basedir, 'profile', name)
 
 
+def create_follow_jobs(job: Job, username: str, source: JobSource = JobSource.FOLLOWING):
+    return (
+        create_child_job(
+            job, username, source=source, authenticated=True),
+        create_child_job(
+            job, username, source=source, authenticated=False),
+    )
+
+
 @wrap_scraper_exceptions_and_logging
-def scrape(session: Session, scraper: AuthenticatedScraper, job: Job):
-    # save accounts followed by target as new targets
-    logger.debug('getting following')
-    n_following = 0
-    for follow in scraper.get_following():
-        # TODO: it's actually possible to get user ID here which is more
-        # stable than username (can use the unauthenticated scraper for it)
-        session.merge(follow)
-        logger.debug(f'is following {follow.follows_username}')
-        if job.own_depth < job.max_depth:
-            session.execute(
-                insert_jobs_on_conflict_ignore(
-                    create_child_job(
-                        job, follow.follows_username, source=JobSource.FOLLOWING, authenticated=True),
-                    create_child_job(
-                        job, follow.follows_username, source=JobSource.FOLLOWING, authenticated=False),
-                )
-            )
-        session.commit()
-        n_following += 1
-    logger.debug(f'saved {n_following} following')
+def scrape(session: Session, scraper: AuthenticatedScraper, job: Job, freshness: FreshnessPolicy):
+    # a resumed job looks fresh because of its own first run
+    if job.checkpoint is None and freshness.is_fresh(session, job):
+        logger.info('scraped recently, enqueueing stored following and followers')
+        with BufferedWriter(session) as writer:
+            if job.own_depth < job.max_depth:
+                for username in freshness.stored_children(session, job):
+                    writer.add_jobs(*create_follow_jobs(job, username))
+                for username in freshness.stored_followers(session, job):
+                    writer.add_jobs(
+                        *create_follow_jobs(job, username, JobSource.FOLLOWER))
+        return
+
+    # save accounts followed by and following the target as new targets
+    logger.debug('getting following and followers')
+    n_follows = {'following': 0, 'followers': 0}
+    checkpoint = Checkpoint(job.checkpoint)
+    with BufferedWriter(session, job=job, checkpoint=checkpoint) as writer:
+        follows = scraper.get_follows(
+            max_following=job.max_followers,
+            max_followers=job.max_followers,
+            checkpoint=checkpoint,
+        )
+        for follow_list, follow in follows:
+            writer.add(follow)
+            # without rest_ids on both ends, resolve_follow_edges adds the
+            # edge later once the accounts have been scraped
+            edge = follow.edge()
+            if edge is not None:
+                writer.add(edge)
+            if follow_list == 'following':
+                logger.debug(f'is following {follow.follows_username}')
+                username, source = follow.follows_username, JobSource.FOLLOWING
+            else:
+                logger.debug(f'is followed by {follow.followed_by_username}')
+                username, source = follow.followed_by_username, JobSource.FOLLOWER
+            if job.own_depth < job.max_depth:
+                writer.add_jobs(*create_follow_jobs(job, username, source))
+            n_follows[follow_list] += 1
+    logger.debug(
+        f'saved {n_follows["following"]} following, {n_follows["followers"]} followers')
 
 
-async def take_worker(session: Session, cooldown_period: int, polling_interval: int = 3,):
+# seconds to wait for an account to free up before trying again
+ACCOUNT_POLLING_INTERVAL = 30
+
+
+def is_rested(cooldown_period: int):
+    return or_(
+        Worker.last_active == None,
+        Worker.last_active < func.now() - datetime.timedelta(seconds=cooldown_period),
+    )
+
+
+def is_available(cooldown_period: int, new_budget: int):
+    '''Filters for accounts that are free and either rested or within budget.'''
+    return (
+        or_(Worker.leased_until == None, Worker.leased_until < func.now()),
+        or_(
+            is_rested(cooldown_period),
+            Worker.jobs_since_rest < func.coalesce(Worker.job_budget, new_budget),
+        ),
+    )
+
+
+def any_worker_available(session: Session, cooldown_period: int, max_jobs: int, max_jobs_jitter: int) -> bool:
+    '''
+    Whether claim_worker would likely find an account, without leasing one.
+    Checked before claiming a job, so a job isn't claimed (and its crawl
+    charged for it) only to be put back while every account rests.
     '''
-    Get next available worker. Cooldown is based on db value.
+    available = session.scalar(
+        select(Worker.id)
+        .filter(*is_available(cooldown_period, max_jobs + max_jobs_jitter))
+        .limit(1)
+    ) is not None
+    session.commit()
+    return available
 
-    :cooldown_period cooldown in seconds (default: 8 hours)
-    :max_jobs max jobs to run before going on cooldown (+/- a random jitter) (default: 5)
+
+def claim_worker(
+    session: Session,
+    cooldown_period: int,
+    max_jobs: int,
+    max_jobs_jitter: int,
+) -> Optional[Worker]:
+    '''
+    Lease the least recently used account that's free and not on cooldown.
+    An account runs `max_jobs` jobs (+/- a random jitter) and then rests for
+    `cooldown_period` seconds after its last job before it's used again.
     '''
-    while True:
-        current_time = datetime.datetime.utcnow()
-        cooldown_threshold = current_time - \
-            datetime.timedelta(seconds=cooldown_period)
-
-        subq = (
-            select(Worker.id)
-            .filter(or_(Worker.last_active == None, Worker.last_active >= cooldown_threshold))
-            .order_by(Worker.last_active)
-            .limit(1)
-            .subquery()
+    rested = is_rested(cooldown_period)
+    new_budget = random.randint(
+        max(max_jobs - max_jobs_jitter, 1), max_jobs + max_jobs_jitter)
+
+    eligible = (
+        select(Worker.id)
+        .filter(*is_available(cooldown_period, new_budget))
+        .order_by(Worker.last_active.nulls_first())
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    worker = session.scalars(
+        update(Worker)
+        .values(
+            last_active=func.now(),
+            leased_until=func.now() + datetime.timedelta(seconds=MAX_JOB_DURATION),
+            jobs_since_rest=case((rested, 1), else_=Worker.jobs_since_rest + 1),
+            job_budget=case(
+                (or_(rested, Worker.job_budget == None), new_budget),
+                else_=Worker.job_budget,
+            ),
         )
-        workers = session.scalars(
-            update(Worker)
-            .values(last_active=current_time)
-            .where(Worker.id.in_(select(subq)))
-            .returning(Worker)
-        ).all()
+        .where(Worker.id.in_(eligible))
+        .returning(Worker)
+    ).first()
+    session.commit()
+    return worker
 
-        if len(workers) > 1:
-            raise Exception('my friend your sql are fucked 🙏😑')
 
-        if len(workers) == 1:
-            logger.debug(f'workers: {workers}')
-            # session.commit()
-            return workers[0]
+def release_worker(engine: Engine, worker: Worker):
+    # own session: the job's may still be in use by a cancelled scrape
+    with Session(engine) as session:
+        session.execute(
+            update(Worker)
+            .values(leased_until=None, last_active=func.now())
+            .where(Worker.id == worker.id)
+        )
+        session.commit()
+
 
-        await asyncio.sleep(polling_interval)
+def release_job(engine: Engine, job: Job):
+    # own session: the job's may be stuck in a failed transaction
+    with Session(engine) as session:
+        release_jobs(session, [job])
 
 
-async def run(concurrency: int, worker_cooldown: int, chrome_data_basedir: str):
+async def run(
+    concurrency: int,
+    worker_cooldown: int,
+    chrome_data_basedir: str,
+    freshness_ttl: Optional[int] = DEFAULT_FRESHNESS_TTL,
+    jitter: Tuple[float, float] = DEFAULT_JITTER,
+    worker_max_jobs: int = 5,
+    worker_max_jobs_jitter: int = 2,
+    lean_browser: bool = False,
+):
     '''
     NB: concurrency should be kept pretty low. Also, it's bounded by how many
     scraper accounts you have available.
+
+    :worker_cooldown seconds an account rests after running its jobs
+    :worker_max_jobs jobs an account runs before resting (+/- worker_max_jobs_jitter)
+    :freshness_ttl don't rescrape accounts scraped less than this many seconds ago
+    :jitter range of seconds to pause between browser actions
+    :lean_browser don't load images, media and fonts, and turn off browser
+        features scraping doesn't need (see init_driver)
     '''
     engine = get_db_engine()
+    freshness = FreshnessPolicy(freshness_ttl)
+    rate_limiter.use_database(engine)
+    notifier = JobNotifier(engine)
+    notifier.start()
+    reaper = asyncio.create_task(reap_periodically(engine))
+    # one browser per worker, not per account ever used
+    drivers = DriverPool(max_size=concurrency)
     init_chrome_dirs(chrome_data_basedir)
 
+    def start_scraper(session: Session, job: Job, worker_config: Worker) -> Tuple[PooledDriver, AuthenticatedScraper]:
+        account = worker_config.twitter_username
+        rest_id = resolve_rest_ids(session, [job.username]).get(job.username)
+        pooled = drivers.get(
+            account,
+            lambda: init_driver(
+                headless=True,
+                profile_dir=get_profile_dir(chrome_data_basedir, account),
+                user_data_dir=get_user_data_dir(chrome_data_basedir, account),
+                proxy=worker_config.proxy,
+                capture_network=True,
+                lean=lean_browser,
+            ),
+        )
+        scraper = AuthenticatedScraper(
+            username=job.username,
+            credentials=Credentials(
+                worker_config.twitter_username,
+                worker_config.twitter_password,
+            ),
+            driver=pooled.driver,
+            logged_in=pooled.logged_in,
+            wait_time=10,
+            jitter=jitter,
+            proxy=worker_config.proxy,
+            capture_network=True,
+            rest_id=rest_id,
+            max_duration=MAX_JOB_DURATION,
+        )
+        return pooled, scraper
+
     async def worker(i: int):
         logger.debug(f'Starting authenticated worker {i}/{concurrency}')
         while True:
+            await throttle.wait()
             with Session(engine) as session:
-                worker_config = await take_worker(session, cooldown_period=worker_cooldown)
-                job = await take_job(session, authenticated=True)
-                scraper = AuthenticatedScraper(
-                    headless=True,
-                    username=job.username,
-                    credentials=Credentials(
-                        worker_config.twitter_username,
-                        worker_config.twitter_password,
-                    ),
-                    profile_dir=get_profile_dir(
-                        chrome_data_basedir,
-                        worker_config.twitter_username,
-                    ),
-                    user_data_dir=get_user_data_dir(
-                        chrome_data_basedir,
-                        worker_config.twitter_username,
-                    ),
-                    wait_time=10
+                available = await asyncio.to_thread(
+                    any_worker_available,
+                    session,
+                    cooldown_period=worker_cooldown,
+                    max_jobs=worker_max_jobs,
+                    max_jobs_jitter=worker_max_jobs_jitter,
+                )
+                if not available:
+                    await asyncio.sleep(ACCOUNT_POLLING_INTERVAL)
+                    continue
+                # job first, so accounts aren't tied up waiting for work
+                job = await take_job(session, authenticated=True, notifier=notifier)
+                worker_config = await asyncio.to_thread(
+                    claim_worker,
+                    session,
+                    cooldown_period=worker_cooldown,
+                    max_jobs=worker_max_jobs,
+                    max_jobs_jitter=worker_max_jobs_jitter,
                 )
-                await asyncio.to_thread(scrape, session, scraper, job)
+                if worker_config is None:
+                    logger.debug('no accounts available, putting job back')
+                    await asyncio.to_thread(release_jobs, session, [job])
+                    await asyncio.sleep(ACCOUNT_POLLING_INTERVAL)
+                    continue
+                account = worker_config.twitter_username
+                try:
+                    try:
+                        pooled, scraper = await asyncio.to_thread(
+                            start_scraper, session, job, worker_config)
+                    except Exception as e:
+                        # chrome didn't start, the database hiccuped... not
+                        # the job's fault, so it goes back as it was
+                        logger.warning(f'could not start scraping {job.username}, putting job back: {e}')
+                        await asyncio.to_thread(release_job, engine, job)
+                        await asyncio.sleep(ACCOUNT_POLLING_INTERVAL)
+                        continue
+                    await asyncio.to_thread(scrape, session, scraper, job, freshness)
+                    pooled.logged_in = scraper.logged_in
+                    await asyncio.to_thread(
+                        drivers.release, account, scraper.network_usage)
+                finally:
+                    await asyncio.to_thread(release_worker, engine, worker_config)
 
-    await asyncio.gather(*[
-        worker(i + 1) for i in range(concurrency)
-    ])
+    try:
+        await asyncio.gather(*[
+            worker(i + 1) for i in range(concurrency)
+        ])
+    finally:
+        reaper.cancel()
+        notifier.close()
+        drivers.quit_all()
@@ -1,83 +1,515 @@
 from __future__ import annotations
 
 import asyncio
-from typing import List
+import datetime
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Set
 
-from sqlalchemy import select, update
+from sqlalchemy import Engine, func, or_, select, true, update
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import PoolProxiedConnection
 
 from common.logging import logger
-from models.job import Job, JobStatus
+from models.job import NEW_JOB_CHANNEL, Crawl, Job, JobStatus
+from runner.deadline import Deadline
+from runner.lease import HEARTBEAT_INTERVAL, MAX_JOB_DURATION, WORKER_ID, Heartbeat, lease_expiry, lease_held, renew_leases
+from runner.retry import MAX_RETRIES, RATE_LIMIT_BACKOFF, RATE_LIMIT_PAUSE, retry_job, throttle
 from scrapers.abstract import Scraper
 from scrapers import exceptions
 
 
-async def take_job(session: Session, authenticated: bool, polling_interval: int = 3) -> Job:
-    while True:
-        subq = (
-            select(Job.internal_id)
-            .filter(Job.status == JobStatus.NEW, Job.is_authenticated == authenticated)
-            .order_by(Job.own_depth, Job.created_at.desc())
-            .limit(1)
-            .subquery()
+# how long to wait for a notification before checking the queue anyway
+NOTIFY_FALLBACK_INTERVAL = 60
+
+
+class JobNotifier:
+    '''
+    Wakes up idle workers when new jobs are inserted (see `notify_new_jobs`).
+
+    Holds a single LISTEN connection per process. The connection's socket is
+    registered with the event loop, so waiting for work costs nothing and
+    workers wake within milliseconds of the inserting transaction committing.
+    '''
+    _engine: Engine
+    _connection: Optional[PoolProxiedConnection]
+    _waiters: Set[asyncio.Event]
+
+    def __init__(self, engine: Engine) -> None:
+        self._engine = engine
+        self._connection = None
+        self._waiters = set()
+
+    def start(self):
+        connection = self._engine.raw_connection()
+        # never hand a connection in LISTEN mode back to the pool
+        connection.detach()
+        dbapi_connection = connection.dbapi_connection
+        dbapi_connection.autocommit = True
+        with dbapi_connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {NEW_JOB_CHANNEL}')
+        asyncio.get_running_loop().add_reader(
+            dbapi_connection.fileno(), self._on_notify)
+        self._connection = connection
+
+    def close(self):
+        if self._connection is None:
+            return
+        asyncio.get_running_loop().remove_reader(
+            self._connection.dbapi_connection.fileno())
+        self._connection.close()
+        self._connection = None
+        self._wake()
+
+    def waiter(self) -> asyncio.Event:
+        '''
+        Register interest in the next notification. Register *before* looking
+        for work so a notification arriving in between isn't missed.
+        '''
+        event = asyncio.Event()
+        self._waiters.add(event)
+        return event
+
+    async def wait(self, event: asyncio.Event, timeout: float):
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.discard(event)
+
+    def discard(self, event: asyncio.Event):
+        self._waiters.discard(event)
+
+    def _on_notify(self):
+        dbapi_connection = self._connection.dbapi_connection
+        dbapi_connection.poll()
+        if dbapi_connection.notifies:
+            dbapi_connection.notifies.clear()
+            self._wake()
+
+    def _wake(self):
+        for event in self._waiters:
+            event.set()
+        self._waiters.clear()
+
+
+def claim_jobs(session: Session, authenticated: bool, n: int = 1) -> List[Job]:
+    '''
+    Mark up to `n` jobs as RUNNING and return them. Rows locked by another
+    claimer are skipped rather than waited on, so concurrent workers never
+    serialize on the head of the queue. Claimed jobs are leased to this
+    process (see runner.lease).
+
+    Crawls share workers by weight: each crawl's next jobs (by priority, then
+    depth) are ranked by the crawl's virtual time plus rank / weight, so a
+    small crawl isn't stuck behind the backlog of a big one (see models.job.Crawl).
+    '''
+    # the top n claimable jobs of each crawl. Locked here, before anything is
+    # cut off by a limit, so concurrent claimers move on to the next jobs
+    # rather than all picking the same ones and skipping them
+    next_jobs = (
+        select(Job.internal_id, Job.priority, Job.own_depth, Job.created_at)
+        .filter(
+            Job.job_id == Crawl.job_id,
+            Job.status == JobStatus.NEW,
+            Job.is_authenticated == authenticated,
+            or_(Job.next_attempt_at == None, Job.next_attempt_at <= func.now()),
         )
-        jobs = session.scalars(
-            update(Job)
-            .values(status=JobStatus.RUNNING)
-            .where(Job.internal_id.in_(select(subq)))
-            .returning(Job)
+        .order_by(Job.priority.desc(), Job.own_depth, Job.created_at.desc())
+        .limit(n)
+        .with_for_update(skip_locked=True)
+        .lateral()
+    )
+    # postgres doesn't allow window functions next to FOR UPDATE, so jobs are
+    # ranked within their crawl out here
+    rank = func.row_number().over(
+        partition_by=Crawl.job_id,
+        order_by=(
+            next_jobs.c.priority.desc(),
+            next_jobs.c.own_depth,
+            next_jobs.c.created_at.desc(),
+        ),
+    )
+    claimable = (
+        select(next_jobs.c.internal_id)
+        .select_from(Crawl)
+        .join(next_jobs, true())
+        .order_by(Crawl.virtual_time + rank / Crawl.weight)
+        .limit(n)
+    )
+    jobs = session.scalars(
+        update(Job)
+        .values(
+            status=JobStatus.RUNNING,
+            worker_id=WORKER_ID,
+            lease_expires_at=lease_expiry(),
+        )
+        .where(Job.internal_id.in_(claimable))
+        .returning(Job)
+    ).all()
+
+    crawl_charges.add([job.job_id for job in jobs])
+    crawl_charges.apply(session)
+    session.commit()
+    return list(jobs)
+
+
+class CrawlCharges:
+    '''
+    Virtual time owed by crawls for the jobs claimed from them (1 / weight
+    each, negative to refund jobs given back), applied to their rows as part
+    of claiming. A crawl row locked by another claimer is skipped rather than
+    waited on and its charge carried over to the next claim, so concurrent
+    claimers of one big crawl don't queue up on its row. Charges a process
+    still owes when it dies are lost, which only makes scheduling a little
+    less fair.
+    '''
+    _owed: Dict[str, int]
+    _lock: threading.Lock
+
+    def __init__(self) -> None:
+        self._owed = {}
+        self._lock = threading.Lock()
+
+    def add(self, job_ids: List[str], refund: bool = False):
+        sign = -1 if refund else 1
+        with self._lock:
+            for job_id, k in Counter(job_ids).items():
+                self._owed[job_id] = self._owed.get(job_id, 0) + sign * k
+
+    def apply(self, session: Session):
+        '''Charge what's owed to every crawl that isn't locked. Caller must commit.'''
+        with self._lock:
+            owed, self._owed = self._owed, {}
+        owed = {job_id: k for job_id, k in owed.items() if k != 0}
+        if len(owed) == 0:
+            return
+
+        locked = session.scalars(
+            select(Crawl.job_id)
+            .filter(Crawl.job_id.in_(list(owed)))
+            .with_for_update(skip_locked=True)
         ).all()
+        for job_id in locked:
+            session.execute(
+                update(Crawl)
+                .values(virtual_time=Crawl.virtual_time + owed[job_id] / Crawl.weight)
+                .where(Crawl.job_id == job_id)
+                .execution_options(synchronize_session=False)
+            )
+
+        skipped = set(owed) - set(locked)
+        if len(skipped) > 0:
+            # carry over the ones that were busy, not ones since archived
+            busy = session.scalars(
+                select(Crawl.job_id).filter(Crawl.job_id.in_(list(skipped)))).all()
+            with self._lock:
+                for job_id in busy:
+                    self._owed[job_id] = self._owed.get(job_id, 0) + owed[job_id]
+
 
-        if len(jobs) > 1:
+crawl_charges = CrawlCharges()
+
+
+async def take_jobs(
+    session: Session,
+    authenticated: bool,
+    n: int,
+    notifier: Optional[JobNotifier] = None,
+    polling_interval: int = 3,
+    wait: bool = True,
+) -> List[Job]:
+    '''
+    Claim up to `n` jobs in one round trip, waiting until at least one is
+    available (unless `wait` is False, then there may be none). With a
+    notifier, waiting is event driven and polling only happens every
+    `NOTIFY_FALLBACK_INTERVAL` seconds in case a notification was lost.
+    '''
+    while True:
+        event = notifier.waiter() if notifier is not None else None
+
+        # the heaviest query there is, keep it off the event loop
+        jobs = await asyncio.to_thread(claim_jobs, session, authenticated, n)
+
+        if len(jobs) > n:
             raise Exception('my friend your sql are fucked 🙏😑')
 
-        if len(jobs) == 1:
-            session.commit()
-            return jobs[0]
+        if len(jobs) > 0 or not wait:
+            if event is not None:
+                notifier.discard(event)
+            return jobs
 
-        await asyncio.sleep(polling_interval)
+        if event is not None:
+            await notifier.wait(event, timeout=NOTIFY_FALLBACK_INTERVAL)
+        else:
+            await asyncio.sleep(polling_interval)
 
 
-def wrap_scraper_exceptions_and_logging(func):
-    def wrapped(session: Session, scraper: Scraper, target: Job, *args, **kwargs):
-        def start():
-            target.status = JobStatus.RUNNING
-            session.merge(target)
-            session.commit()
+async def take_job(
+    session: Session,
+    authenticated: bool,
+    notifier: Optional[JobNotifier] = None,
+    polling_interval: int = 3,
+) -> Job:
+    jobs = await take_jobs(session, authenticated, 1, notifier, polling_interval)
+    return jobs[0]
 
-        def finish():
-            target.status = JobStatus.FINISHED
-            session.merge(target)
-            session.commit()
 
-        def error():
-            target.status = JobStatus.ERROR
-            session.merge(target)
-            session.commit()
+def release_jobs(session: Session, jobs: List[Job]):
+    '''
+    Give claimed jobs that were never started back to the queue, and refund
+    their crawls what claiming them cost (see claim_jobs). Jobs no longer
+    leased to this process are left to whoever has them now.
+    '''
+    if len(jobs) == 0:
+        return
+    released = session.scalars(
+        update(Job)
+        .values(status=JobStatus.NEW, worker_id=None, lease_expires_at=None)
+        .where(
+            Job.internal_id.in_([job.internal_id for job in jobs]),
+            *lease_held(),
+        )
+        .returning(Job.job_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+    crawl_charges.add(released, refund=True)
+    crawl_charges.apply(session)
+    session.commit()
 
+
+class JobQueue:
+    '''
+    In-process buffer of leased jobs shared by all workers of a runner.
+
+    Jobs are claimed from the database `batch_size` at a time, so short jobs
+    don't pay a queue round trip each. Jobs handed out by `get` are detached
+    from the queue's session; workers merge them into their own. Call
+    `release` on shutdown to give back jobs that were leased but never
+    started. Leases on jobs waiting in the queue are renewed in the
+    background, as they have no Heartbeat yet. With a deadline, no more jobs
+    are handed out once they're not expected to finish in time.
+    '''
+    _engine: Engine
+    _authenticated: bool
+    _batch_size: int
+    _max_jobs: Optional[int]
+    _notifier: Optional[JobNotifier]
+    _deadline: Optional[Deadline]
+    _jobs: List[Job]
+    _n_claimed: int
+    _lock: asyncio.Lock
+    _renewer: Optional[asyncio.Task]
+
+    def __init__(
+        self,
+        engine: Engine,
+        authenticated: bool,
+        batch_size: int,
+        max_jobs: Optional[int] = None,
+        notifier: Optional[JobNotifier] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> None:
+        self._engine = engine
+        self._authenticated = authenticated
+        self._batch_size = batch_size
+        self._max_jobs = max_jobs
+        self._notifier = notifier
+        self._deadline = deadline
+        self._jobs = []
+        self._n_claimed = 0
+        self._lock = asyncio.Lock()
+        self._renewer = None
+
+    async def get(self) -> Optional[Job]:
+        '''
+        Next leased job, or None once `max_jobs` have been handed out or
+        there's no time left for another. With a deadline, also None when
+        there's nothing to claim rather than waiting (and paying) for new
+        jobs until time runs out.
+        '''
+        async with self._lock:
+            if self._deadline is not None and not self._deadline.fits():
+                return None
+            if len(self._jobs) == 0:
+                n = self._batch_size
+                if self._max_jobs is not None:
+                    n = min(n, self._max_jobs - self._n_claimed)
+                if n <= 0:
+                    return None
+
+                with Session(self._engine, expire_on_commit=False) as session:
+                    jobs = await take_jobs(
+                        session, self._authenticated, n, notifier=self._notifier,
+                        wait=self._deadline is None)
+                    session.expunge_all()
+                if len(jobs) == 0:
+                    return None
+                self._jobs.extend(jobs)
+                self._n_claimed += len(jobs)
+                logger.debug(f'leased {len(jobs)} jobs')
+                if self._renewer is None:
+                    self._renewer = asyncio.create_task(self._renew_periodically())
+                # claiming takes time too. Whatever isn't handed out is
+                # released on shutdown
+                if self._deadline is not None and not self._deadline.fits():
+                    return None
+
+            return self._jobs.pop(0)
+
+    def _renew(self, jobs: List[Job]):
+        with Session(self._engine) as session:
+            return renew_leases(session, jobs)
+
+    async def _renew_periodically(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            jobs = list(self._jobs)
+            if len(jobs) == 0:
+                continue
+            try:
+                held = await asyncio.to_thread(self._renew, jobs)
+            except Exception as e:
+                # try again next time, the leases have some slack
+                logger.warning(f'could not renew leases on queued jobs: {e}')
+                continue
+            lost = {job.internal_id for job in jobs} - held
+            if len(lost) > 0:
+                # reaped or claimed elsewhere, don't run them here too
+                logger.warning(f'lost the lease on {len(lost)} queued jobs')
+                self._jobs = [job for job in self._jobs if job.internal_id not in lost]
+
+    def release(self):
+        if self._renewer is not None:
+            self._renewer.cancel()
+            self._renewer = None
+        jobs, self._jobs = self._jobs, []
+        with Session(self._engine) as session:
+            release_jobs(session, jobs)
+        if len(jobs) > 0:
+            logger.info(f'released {len(jobs)} unstarted jobs')
+
+
+def set_job_status(session: Session, target: Job, status: JobStatus) -> bool:
+    '''
+    Update a job this process claimed. Nothing is written once the lease is
+    lost (it ran out, and the job may be running elsewhere by now), so a slow
+    run can't overwrite the outcome of the run that replaced it. Returns
+    whether the job was updated.
+    '''
+    values = dict(status=status)
+    if status == JobStatus.RUNNING:
+        values.update(started_at=datetime.datetime.utcnow(), finished_at=None)
+    else:
+        values.update(worker_id=None, lease_expires_at=None)
+    if status in (JobStatus.FINISHED, JobStatus.ERROR):
+        # nothing left to resume
+        values.update(finished_at=datetime.datetime.utcnow(), checkpoint=None)
+    result = session.execute(
+        update(Job)
+        .values(**values)
+        .where(Job.internal_id == target.internal_id, *lease_held())
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+    if result.rowcount == 0:
+        logger.warning(f'lost the lease on {target.username}, not setting it {status.name}')
+        return False
+    return True
+
+
+def requeue_job(engine: Engine, target: Job):
+    with Session(engine) as session:
+        set_job_status(session, target, JobStatus.NEW)
+
+
+def handle_scraper_exception(session: Session, target: Job, e: Exception):
+    '''
+    Log an exception raised by a scraper and finish, fail or retry the job.
+    Anything not known to be permanent is retried (see runner.retry).
+    '''
+    # the error may have left the session's transaction aborted (e.g. while
+    # the writer was saving), which would fail the status update too
+    session.rollback()
+    if isinstance(e, exceptions.UserNotFound):
+        logger.warning(f'(user not found) skipping {e.username}')
+        return set_job_status(session, target, JobStatus.FINISHED)
+    if isinstance(e, exceptions.UserProtected):
+        logger.warning(f'(user is protected) skipping {e.username}')
+        return set_job_status(session, target, JobStatus.FINISHED)
+    if isinstance(e, exceptions.PermanentException):
+        logger.error(f'(permanent scraper error) {e.username}, {e}')
+        return set_job_status(session, target, JobStatus.ERROR)
+    if isinstance(e, exceptions.RateLimited):
+        logger.warning(f'(rate limited) retrying {e.username} later, {e.info}')
+        throttle.pause(RATE_LIMIT_PAUSE)
+        return retry_job(session, target, delay=e.retry_after or RATE_LIMIT_BACKOFF, where=lease_held())
+
+    if isinstance(e, exceptions.TransientException):
+        logger.warning(f'(transient scraper error) {e.username}, {e.info}')
+    elif isinstance(e, exceptions.UnknownException):
+        logger.error(f'(unknown scraper error) {e.username}, {e.info}')
+    else:
+        logger.error(
+            f'(completely unanticipated error) {target.username}, {e}')
+    if target.retry_count < MAX_RETRIES:
+        return retry_job(session, target, where=lease_held())
+    logger.error(f'(out of retries) giving up on {target.username}')
+    set_job_status(session, target, JobStatus.ERROR)
+
+
+def wrap_scraper_exceptions_and_logging(func):
+    def wrapped(session: Session, scraper: Scraper, target: Job, *args, **kwargs):
         with logger.contextualize(scraper=scraper.id(), target=target.username, job=target.job_id):
             try:
-                start()
-                func(session, scraper, target, *args, **kwargs)
-            except exceptions.UserNotFound as e:
-                logger.warning(f'(user not found) skipping {e.username}')
-                finish()
-            except exceptions.UserProtected as e:
-                logger.warning(f'(user is protected) skipping {e.username}')
-                finish()
-            except exceptions.UnknownException as e:
-                logger.error(f'(unknown scraper error) {e.username}, {e.info}')
-                error()
+                if not set_job_status(session, target, JobStatus.RUNNING):
+                    # reaped or claimed elsewhere since it was leased
+                    return
+                with Heartbeat(session.get_bind(), target):
+                    func(session, scraper, target, *args, **kwargs)
             except KeyboardInterrupt as e:
                 logger.error(f'(keyboard interrupt) {target.username}')
-                error()
+                set_job_status(session, target, JobStatus.ERROR)
                 raise e
             except Exception as e:
-                logger.error(
-                    f'(completely unanticipated error) {target.username}, {e}')
-                error()
+                handle_scraper_exception(session, target, e)
+            else:
+                set_job_status(session, target, JobStatus.FINISHED)
+
+    return wrapped
+
+
+def wrap_async_scraper_exceptions_and_logging(func):
+    '''
+    Same as `wrap_scraper_exceptions_and_logging` for async scrape functions.
+    Status updates run in a thread so they never block the event loop, and a
+    cancelled job goes back to the queue. A job still running after
+    `MAX_JOB_DURATION` is cancelled and retried, resuming from its checkpoint.
+    '''
+    async def wrapped(session: Session, scraper, target: Job, *args, **kwargs):
+        with logger.contextualize(scraper=scraper.id(), target=target.username, job=target.job_id):
+            try:
+                if not await asyncio.to_thread(set_job_status, session, target, JobStatus.RUNNING):
+                    # reaped or claimed elsewhere since it was leased
+                    return
+                with Heartbeat(session.get_bind(), target):
+                    try:
+                        await asyncio.wait_for(
+                            func(session, scraper, target, *args, **kwargs), MAX_JOB_DURATION)
+                    except asyncio.TimeoutError as e:
+                        raise exceptions.TransientException(
+                            target.username, f'ran for over {MAX_JOB_DURATION}s') from e
+            except asyncio.CancelledError:
+                logger.warning(f'(cancelled) requeueing {target.username}')
+                # the cancelled task may have left a thread still using the
+                # session, so requeue through a separate one
+                await asyncio.to_thread(requeue_job, session.get_bind(), target)
+                raise
+            except Exception as e:
+                await asyncio.to_thread(handle_scraper_exception, session, target, e)
             else:
-                finish()
+                await asyncio.to_thread(set_job_status, session, target, JobStatus.FINISHED)
 
     return wrapped
 
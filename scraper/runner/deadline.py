@@ -0,0 +1,97 @@
+'''
+Fit jobs into a fixed amount of time (e.g. a lambda invocation): only start
+jobs that are expected to finish before the deadline, going by how long
+recent jobs took.
+'''
+import threading
+import time
+from collections import deque
+from typing import Deque, List
+
+from sqlalchemy import Engine, func, select
+from sqlalchemy.orm import Session
+
+from models.job import Job, JobStatus
+
+
+# seconds, assumed until there's any history
+DEFAULT_JOB_DURATION = 30
+# how many recent jobs the estimate is based on
+HISTORY_SIZE = 100
+# estimate from the slow end of recent jobs, so most fit
+ESTIMATE_QUANTILE = 0.9
+
+
+def recent_job_durations(session: Session, authenticated: bool, n: int = HISTORY_SIZE) -> List[float]:
+    '''Seconds taken by the last `n` finished jobs, newest first.'''
+    return [
+        float(seconds) for seconds in session.scalars(
+            select(func.extract('epoch', Job.finished_at - Job.started_at))
+            .filter(
+                Job.is_authenticated == authenticated,
+                Job.status == JobStatus.FINISHED,
+                Job.started_at != None,
+                Job.finished_at != None,
+            )
+            .order_by(Job.finished_at.desc())
+            .limit(n)
+        )
+    ]
+
+
+class JobDurations:
+    '''
+    Rolling history of job durations. Starts from what's in the database and
+    is updated as jobs finish, so keep one around (e.g. at module scope in a
+    lambda) to skip reloading.
+    '''
+    _durations: Deque[float]
+    _loaded: bool
+    _lock: threading.Lock
+
+    def __init__(self) -> None:
+        self._durations = deque(maxlen=HISTORY_SIZE)
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def load(self, engine: Engine, authenticated: bool):
+        '''Seed from recently finished jobs, once.'''
+        if self._loaded:
+            return
+        with Session(engine) as session:
+            durations = recent_job_durations(session, authenticated)
+        with self._lock:
+            # oldest first, so jobs finishing now push out the oldest
+            self._durations.extendleft(durations)
+            self._loaded = True
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._durations.append(seconds)
+
+    def estimate(self) -> float:
+        with self._lock:
+            if len(self._durations) == 0:
+                return DEFAULT_JOB_DURATION
+            durations = sorted(self._durations)
+        return durations[int(ESTIMATE_QUANTILE * (len(durations) - 1))]
+
+
+class Deadline:
+    _at: float
+    durations: JobDurations
+
+    def __init__(self, seconds: float, durations: JobDurations) -> None:
+        '''
+        :seconds from now until jobs must be done (leave time to flush and
+            release leases after)
+        '''
+        self._at = time.monotonic() + seconds
+        self.durations = durations
+
+    def remaining(self) -> float:
+        return max(self._at - time.monotonic(), 0)
+
+    def fits(self) -> bool:
+        '''Whether a job started now is expected to finish in time.'''
+        return self.remaining() >= self.durations.estimate()
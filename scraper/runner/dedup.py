@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional, Set, Tuple
+
+
+# (job_id, username, is_authenticated), same as the job uniqueness constraint
+JobKey = Tuple[str, str, bool]
+
+
+class BloomFilter:
+    '''
+    Fixed-size set membership with false positives but no false negatives.
+    A false positive means a child job is skipped, which is fine for a crawl
+    frontier but means this shouldn't be used where every account matters.
+    '''
+    _bits: bytearray
+    _n_bits: int
+    _n_hashes: int
+
+    def __init__(self, n_bits: int, n_hashes: int = 4) -> None:
+        self._bits = bytearray((n_bits + 7) // 8)
+        self._n_bits = n_bits
+        self._n_hashes = n_hashes
+
+    def _positions(self, item: str) -> Iterable[int]:
+        digest = hashlib.blake2b(item.encode(), digest_size=8 * self._n_hashes).digest()
+        for i in range(self._n_hashes):
+            yield int.from_bytes(digest[i * 8:(i + 1) * 8], 'little') % self._n_bits
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self._bits[position // 8] & (1 << (position % 8))
+            for position in self._positions(item)
+        )
+
+
+class EnqueuedJobs:
+    '''
+    Child jobs this process has already enqueued, so repeats (an account
+    replying to the same person 200 times) are dropped before any SQL is
+    issued. Shared by all workers of the process, which run scrapes in
+    threads, hence the lock.
+
+    By default this keeps exact per-crawl sets for the `max_crawls` most
+    recently active crawls. With a bloom filter, memory is fixed instead, at
+    the cost of occasionally skipping a job that wasn't enqueued.
+    '''
+    _crawls: OrderedDict[str, Set[Tuple[str, bool]]]
+    _max_crawls: int
+    _bloom: Optional[BloomFilter]
+    _lock: threading.Lock
+
+    def __init__(self, max_crawls: int = 32, bloom: Optional[BloomFilter] = None) -> None:
+        self._crawls = OrderedDict()
+        self._max_crawls = max_crawls
+        self._bloom = bloom
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: JobKey) -> bool:
+        job_id, username, is_authenticated = key
+        with self._lock:
+            if self._bloom is not None:
+                return f'{job_id}:{username}:{is_authenticated}' in self._bloom
+            crawl = self._crawls.get(job_id)
+            return crawl is not None and (username, is_authenticated) in crawl
+
+    def add(self, keys: Iterable[JobKey]):
+        with self._lock:
+            for job_id, username, is_authenticated in keys:
+                if self._bloom is not None:
+                    self._bloom.add(f'{job_id}:{username}:{is_authenticated}')
+                    continue
+                if job_id not in self._crawls:
+                    self._crawls[job_id] = set()
+                    if len(self._crawls) > self._max_crawls:
+                        self._crawls.popitem(last=False)
+                self._crawls.move_to_end(job_id)
+                self._crawls[job_id].add((username, is_authenticated))
+
+
+def _from_env() -> EnqueuedJobs:
+    bloom_bits = os.environ.get('SCRAPER_DEDUP_BLOOM_BITS')
+    if bloom_bits is not None:
+        return EnqueuedJobs(bloom=BloomFilter(int(bloom_bits)))
+    return EnqueuedJobs()
+
+
+enqueued_jobs = _from_env()
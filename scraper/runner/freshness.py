@@ -0,0 +1,110 @@
+'''
+Skip scraping accounts that were scraped recently, possibly by another crawl.
+Each root submission gets its own job_id, so the job uniqueness constraint
+never stops overlapping crawls from scraping the same account twice.
+'''
+import datetime
+from typing import List, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from models.account import Account
+from models.interaction import Follow, Tweet
+from models.job import Job, JobArchive, JobStatus
+
+
+# seconds
+DEFAULT_FRESHNESS_TTL = 60 * 60 * 24
+
+
+class FreshnessPolicy:
+    '''
+    An account is fresh if a job of the same kind (anonymous or
+    authenticated) finished scraping it less than `ttl` seconds ago, in any
+    crawl. Only finished jobs count: one that failed partway has already
+    stored some of the account, but not all of it. A ttl of None disables the
+    check.
+    '''
+    _ttl: Optional[datetime.timedelta]
+
+    def __init__(self, ttl: Optional[int] = DEFAULT_FRESHNESS_TTL) -> None:
+        self._ttl = datetime.timedelta(seconds=ttl) if ttl else None
+
+    def is_fresh(self, session: Session, job: Job) -> bool:
+        if self._ttl is None:
+            return False
+
+        # finished_at is set in UTC by the runner, not by the db
+        threshold = datetime.datetime.utcnow() - self._ttl
+        for model in (Job, JobArchive):
+            finished = session.scalars(
+                select(model.internal_id)
+                .filter(
+                    model.username == job.username,
+                    model.is_authenticated == job.is_authenticated,
+                    model.status == JobStatus.FINISHED,
+                    model.finished_at >= threshold,
+                )
+                .limit(1)
+            ).first()
+            if finished is not None:
+                return True
+        return False
+
+    def stored_followers(self, session: Session, job: Job) -> List[str]:
+        '''Followers the last scrape of an authenticated job found.'''
+        return list(session.scalars(
+            select(Follow.followed_by_username)
+            .filter(Follow.follows_username == job.username)
+            .distinct()
+        ))
+
+    def stored_children(self, session: Session, job: Job) -> List[str]:
+        '''
+        Usernames the last scrape of this account found as new targets (for
+        authenticated jobs, who it follows, see also stored_followers).
+        '''
+        if job.is_authenticated:
+            return list(session.scalars(
+                select(Follow.follows_username)
+                .filter(Follow.followed_by_username == job.username)
+                .distinct()
+            ))
+
+        return list(session.scalars(
+            select(Tweet.reply_to_account_username)
+            .join(Account, Account.rest_id == Tweet.author_rest_id)
+            .filter(
+                Account.username == job.username,
+                Tweet.is_reply,
+                Tweet.reply_to_account_username != None,
+            )
+            .distinct()
+        ))
+
+
+def incremental_since_id(session: Session, job: Job) -> Optional[str]:
+    '''
+    rest_id of the newest stored tweet of the job's account, to stop paginating
+    once the scrape reaches tweets we already have. Only returned if what's
+    stored already covers `max_tweets` (or the whole account), otherwise a
+    previous, smaller scrape would cap this one.
+    '''
+    account = session.scalars(
+        select(Account).filter(Account.username == job.username).limit(1)
+    ).first()
+    if account is None:
+        return None
+
+    n_stored = session.scalar(
+        select(func.count()).filter(Tweet.author_rest_id == account.rest_id))
+    if n_stored < min(job.max_tweets, account.statuses_count):
+        return None
+
+    return session.scalars(
+        select(Tweet.rest_id)
+        .filter(Tweet.author_rest_id == account.rest_id)
+        .order_by(Tweet.created_on.desc())
+        .limit(1)
+    ).first()
@@ -0,0 +1,60 @@
+'''
+What goes into a crawl's frontier, and in which order it's scraped.
+
+Across crawls, runner.base.claim_jobs shares workers by crawl weight. Within a
+crawl, jobs are claimed by priority (highest first), then depth. Priorities
+are set when child jobs are enqueued, from a pluggable `PriorityScore`, and a
+crawl stops growing once it reaches its account budget.
+'''
+from typing import Callable, Dict, List
+
+from sqlalchemy.orm import Session
+
+from models.job import Job, count_crawl_accounts, crawl_budget, insert_jobs_on_conflict_ignore
+
+
+# (child job, number of edges the parent job found to it) -> priority
+PriorityScore = Callable[[Job, int], float]
+
+
+def default_priority(job: Job, n_edges: int) -> float:
+    '''Accounts the target interacts with more often go first.'''
+    return n_edges
+
+
+def enqueue_jobs(session: Session, jobs: List[Job], max_rows: int) -> int:
+    '''
+    Insert child jobs within their crawl's account budget, keeping the highest
+    priority ones if the budget runs out. Returns the number of jobs inserted.
+    Concurrent jobs of one crawl may overshoot the budget by a batch. Caller
+    must commit.
+    '''
+    by_crawl: Dict[str, List[Job]] = {}
+    for job in jobs:
+        by_crawl.setdefault(job.job_id, []).append(job)
+
+    n_inserted = 0
+    for job_id, batch in by_crawl.items():
+        budget = crawl_budget(session, job_id)
+        if budget is not None:
+            batch = within_budget(batch, budget)
+
+        usernames = set()
+        # stay well under postgres' limit on bind parameters per statement
+        for i in range(0, len(batch), max_rows):
+            inserted = session.scalars(
+                insert_jobs_on_conflict_ignore(*batch[i:i + max_rows])).all()
+            usernames.update(inserted)
+            n_inserted += len(inserted)
+        if len(usernames) > 0:
+            count_crawl_accounts(session, job_id, len(usernames))
+    return n_inserted
+
+
+def within_budget(jobs: List[Job], budget: int) -> List[Job]:
+    '''Jobs for the `budget` highest priority accounts.'''
+    priorities: Dict[str, float] = {}
+    for job in jobs:
+        priorities[job.username] = max(job.priority, priorities.get(job.username, job.priority))
+    kept = set(sorted(priorities, key=priorities.get, reverse=True)[:budget])
+    return [job for job in jobs if job.username in kept]
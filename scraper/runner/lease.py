@@ -0,0 +1,168 @@
+'''
+Claiming a job leases it to this process for `LEASE_DURATION` seconds, and a
+`Heartbeat` keeps renewing the lease for as long as the job runs. When a
+process dies (crash, lambda timeout), its lease runs out and
+`reap_expired_leases` puts the job back in the queue. Jobs that run too long
+are stopped by their runner (see MAX_JOB_DURATION), never by letting the lease
+lapse while they're still running, which would get them run twice. Jobs
+leased in a batch and still waiting to start are renewed by their queue
+(see runner.base.JobQueue).
+'''
+import asyncio
+import contextvars
+import datetime
+import os
+import socket
+import threading
+from typing import List, Set
+
+from sqlalchemy import Engine, func, update
+from sqlalchemy.orm import Session
+
+from common.logging import logger
+from models.job import Job, JobStatus
+from runner.retry import MAX_RETRIES, retry_at
+
+
+# identifies this process in Job.worker_id
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+# seconds
+LEASE_DURATION = 5 * 60
+HEARTBEAT_INTERVAL = 60
+# runners stop a job after this long, and it's retried (resuming from its
+# checkpoint)
+MAX_JOB_DURATION = 60 * 60
+
+
+def lease_expiry():
+    # on the db clock, like everything the reaper compares it to
+    return func.now() + datetime.timedelta(seconds=LEASE_DURATION)
+
+
+def lease_held():
+    '''Filters for a job this process is running and still has the lease on.'''
+    return (
+        Job.worker_id == WORKER_ID,
+        Job.status == JobStatus.RUNNING,
+        Job.lease_expires_at > func.now(),
+    )
+
+
+def renew_leases(session: Session, targets: List[Job]) -> Set[int]:
+    '''Extend the leases on jobs. Returns the internal_ids of those still ours.'''
+    if len(targets) == 0:
+        return set()
+    renewed = session.scalars(
+        update(Job)
+        .values(lease_expires_at=lease_expiry())
+        .where(
+            Job.internal_id.in_([target.internal_id for target in targets]),
+            Job.worker_id == WORKER_ID,
+            Job.status == JobStatus.RUNNING,
+        )
+        .returning(Job.internal_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+    session.commit()
+    return set(renewed)
+
+
+def renew_lease(session: Session, target: Job) -> bool:
+    '''Extend the lease on a job. False if it's no longer ours.'''
+    return target.internal_id in renew_leases(session, [target])
+
+
+def reap_expired_leases(session: Session) -> int:
+    '''
+    Requeue running jobs whose lease ran out, with backoff. Jobs that already
+    used up their retries fail instead. Returns how many jobs were reaped.
+    '''
+    expired = (
+        Job.status == JobStatus.RUNNING,
+        Job.lease_expires_at < func.now(),
+    )
+    released = dict(worker_id=None, lease_expires_at=None)
+    n_failed = session.execute(
+        update(Job)
+        .values(status=JobStatus.ERROR, **released)
+        .where(*expired, Job.retry_count >= MAX_RETRIES)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    n_requeued = session.execute(
+        update(Job)
+        .values(
+            status=JobStatus.NEW,
+            retry_count=Job.retry_count + 1,
+            next_attempt_at=retry_at(Job.retry_count),
+            **released,
+        )
+        .where(*expired)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    session.commit()
+
+    if n_failed + n_requeued > 0:
+        logger.warning(
+            f'reaped expired leases: requeued {n_requeued}, gave up on {n_failed}')
+    return n_failed + n_requeued
+
+
+async def reap_periodically(engine: Engine, interval: float = LEASE_DURATION):
+    '''Run the reaper now and then every `interval` seconds, until cancelled.'''
+    def reap():
+        with Session(engine) as session:
+            reap_expired_leases(session)
+
+    while True:
+        try:
+            await asyncio.to_thread(reap)
+        except Exception as e:
+            logger.error(f'could not reap expired leases: {e}')
+        await asyncio.sleep(interval)
+
+
+class Heartbeat:
+    '''
+    Renews the lease on a job from a background thread while it runs, so it
+    works the same for jobs running on the event loop and in threads. Use as a
+    context manager.
+    '''
+    _engine: Engine
+    _target: Job
+    _interval: float
+    _stopped: threading.Event
+
+    def __init__(
+        self,
+        engine: Engine,
+        target: Job,
+        interval: float = HEARTBEAT_INTERVAL,
+    ) -> None:
+        self._engine = engine
+        self._target = target
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def _beat(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                with Session(self._engine) as session:
+                    if not renew_lease(session, self._target):
+                        logger.warning('lost the lease on this job')
+                        return
+            except Exception as e:
+                # try again next time, the lease has some slack
+                logger.warning(f'could not renew lease: {e}')
+
+    def __enter__(self):
+        # copy the context so the thread logs with the job's context
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(self._beat,),
+            daemon=True,
+        ).start()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self._stopped.set()
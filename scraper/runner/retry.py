@@ -0,0 +1,82 @@
+'''
+Failed jobs go back in the queue with exponential backoff (see `retry_job`)
+until they run out of retries. Rate limited jobs wait for the limit to reset
+instead, and pause this process' workers so they don't burn through the queue
+while throttled.
+'''
+import asyncio
+import datetime
+import time
+from typing import Iterable, Optional
+
+from sqlalchemy import ColumnElement, func, literal_column, update
+from sqlalchemy.orm import Session
+
+from models.job import Job, JobStatus
+
+
+MAX_RETRIES = 5
+# seconds before retrying, doubled on every retry
+RETRY_BACKOFF = 60
+MAX_RETRY_BACKOFF = 60 * 60
+# seconds, twitter's rate limit windows are 15 minutes
+RATE_LIMIT_BACKOFF = 15 * 60
+# how long all workers of a process pause when one gets rate limited
+RATE_LIMIT_PAUSE = 60
+
+
+def retry_at(retry_count):
+    '''When to try again after `retry_count` previous retries.'''
+    seconds = func.least(
+        RETRY_BACKOFF * func.power(2, retry_count), MAX_RETRY_BACKOFF)
+    return func.now() + seconds * literal_column("interval '1 second'")
+
+
+def retry_job(
+    session: Session,
+    target: Job,
+    delay: Optional[float] = None,
+    where: Iterable[ColumnElement[bool]] = (),
+) -> bool:
+    '''
+    Put a failed job back in the queue. It counts as a retry and backs off
+    exponentially, unless a `delay` (seconds) is given, e.g. until a rate
+    limit resets, which isn't the job's fault. Only if the job still matches
+    `where` (e.g. runner.lease.lease_held). Returns whether it was requeued.
+    '''
+    if delay is None:
+        values = dict(
+            retry_count=Job.retry_count + 1,
+            next_attempt_at=retry_at(Job.retry_count),
+        )
+    else:
+        values = dict(
+            next_attempt_at=func.now() + datetime.timedelta(seconds=delay),
+        )
+    result = session.execute(
+        update(Job)
+        .values(status=JobStatus.NEW, worker_id=None, lease_expires_at=None, **values)
+        .where(Job.internal_id == target.internal_id, *where)
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+    return result.rowcount > 0
+
+
+class Throttle:
+    '''Lets one worker pause all workers of a process.'''
+    _until: float
+
+    def __init__(self) -> None:
+        self._until = 0
+
+    def pause(self, seconds: float):
+        self._until = max(self._until, time.monotonic() + seconds)
+
+    async def wait(self):
+        delay = self._until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+throttle = Throttle()
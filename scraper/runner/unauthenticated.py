@@ -1,71 +1,173 @@
 import asyncio
+import time
 
-from typing import Optional
+from typing import Awaitable, List, Optional
 
 from loguru import logger
+from sqlalchemy import Engine
 from sqlalchemy.orm import Session
 
 from models import get_db_engine
 from models.job import Job, JobSource
-from models.job import create_child_job, insert_jobs_on_conflict_ignore
-from runner.base import Progress
-from runner.base import take_job, wrap_scraper_exceptions_and_logging
-from scrapers.unauthenticated import UnauthenticatedScraper
+from models.job import create_child_job
+from runner.base import JobNotifier, JobQueue, Progress
+from runner.base import wrap_async_scraper_exceptions_and_logging
+from runner.deadline import Deadline
+from runner.lease import reap_periodically
+from runner.retry import throttle
+from runner.freshness import DEFAULT_FRESHNESS_TTL, FreshnessPolicy, incremental_since_id
+from runner.writer import BufferedWriter
+from scrapers.checkpoint import Checkpoint
+from scrapers.ratelimit import rate_limiter
+from scrapers.unauthenticated import AsyncUnauthenticatedScraper
 
 
-@wrap_scraper_exceptions_and_logging
-def scrape(session: Session, scraper: UnauthenticatedScraper, job: Job):
+def create_reply_jobs(job: Job, username: str):
+    return (
+        create_child_job(job, username,
+                         source=JobSource.TWEET_REPLY, authenticated=False),
+        create_child_job(job, username,
+                         source=JobSource.TWEET_REPLY, authenticated=True),
+    )
+
+
+def enqueue_stored_children(session: Session, job: Job, freshness: FreshnessPolicy):
+    with BufferedWriter(session) as writer:
+        if job.own_depth < job.max_depth:
+            for username in freshness.stored_children(session, job):
+                writer.add_jobs(*create_reply_jobs(job, username))
+
+
+async def gather_or_raise(*aws: Awaitable) -> List:
+    '''Like asyncio.gather, but waits for all of them before raising.'''
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+@wrap_async_scraper_exceptions_and_logging
+async def scrape(session: Session, scraper: AsyncUnauthenticatedScraper, job: Job, freshness: FreshnessPolicy):
+    checkpoint = Checkpoint(job.checkpoint)
+    # a resumed job looks fresh because of its own first run
+    resuming = 'tweets_pages' in checkpoint.state
+    if not resuming and await asyncio.to_thread(freshness.is_fresh, session, job):
+        logger.info('scraped recently, enqueueing stored reply targets')
+        await asyncio.to_thread(enqueue_stored_children, session, job, freshness)
+        return
+
     logger.debug('getting account info')
-    session.merge(scraper.get_user_info())
-
-    logger.info(f'getting tweets and replies')
-    n_tweets = 0
-    for tweet in scraper.get_tweets(max_tweets=job.max_tweets):
-        logger.debug(f'tweet id {tweet.rest_id} ({tweet.content[:20]}...)')
-        session.merge(tweet)
-        if tweet.is_reply and job.own_depth < job.max_depth:
-            session.execute(
-                insert_jobs_on_conflict_ignore(
-                    create_child_job(job, tweet.reply_to_account_username,
-                                     source=JobSource.TWEET_REPLY, authenticated=False),
-                    create_child_job(job, tweet.reply_to_account_username,
-                                     source=JobSource.TWEET_REPLY, authenticated=True)
-                )
-            )
-        session.commit()
-
-        session.commit()
-        n_tweets += 1
-    session.commit()
+    if resuming:
+        # what the first run had stored, not including its own tweets
+        since_id = checkpoint.get('since_id')
+        logger.info(f'resuming after page {checkpoint.get("tweets_pages")}')
+        account = await scraper.get_user_info()
+    else:
+        # the account lookup is a request, run it while the query runs. Both
+        # have to be done before an error is handled, which uses the session
+        since_id, account = await gather_or_raise(
+            asyncio.to_thread(incremental_since_id, session, job),
+            scraper.get_user_info(),
+        )
+        checkpoint.set(since_id=since_id)
+    # end the read transaction, no need to hold a connection while scraping
+    await asyncio.to_thread(session.commit)
+
+    async with BufferedWriter(session, job=job, checkpoint=checkpoint) as writer:
+        writer.add(account)
+
+        logger.info(f'getting tweets and replies (since {since_id})')
+        n_tweets = 0
+        tweets = scraper.get_tweets(
+            max_tweets=job.max_tweets, since_id=since_id, checkpoint=checkpoint)
+        async for tweet in tweets:
+            logger.debug(f'tweet id {tweet.rest_id} ({tweet.content[:20]}...)')
+            writer.add(tweet)
+            if tweet.is_reply and job.own_depth < job.max_depth:
+                writer.add_jobs(
+                    *create_reply_jobs(job, tweet.reply_to_account_username))
+            n_tweets += 1
+            await writer.flush_if_needed()
     logger.info(f'saved {n_tweets} tweets')
 
 
-async def run(concurrency: int = 8, max_jobs: Optional[int] = None, cooldown: Optional[int] = None):
-    engine = get_db_engine()
+async def run(
+    concurrency: int = 8,
+    max_jobs: Optional[int] = None,
+    cooldown: Optional[int] = None,
+    batch_size: Optional[int] = None,
+    freshness_ttl: Optional[int] = DEFAULT_FRESHNESS_TTL,
+    engine: Optional[Engine] = None,
+    listen: bool = True,
+    deadline: Optional[Deadline] = None,
+):
+    '''
+    :batch_size how many jobs to lease per queue round trip (default: concurrency)
+    :freshness_ttl don't rescrape accounts scraped less than this many seconds ago
+    :engine reuse an engine (default: a new one)
+    :listen wait for new jobs with LISTEN rather than polling. Needs a
+        session-level connection, so not through a transaction pooler.
+    :deadline stop starting jobs once they're not expected to finish in time
+        or there are none left, and requeue the ones still running when it's
+        reached
+    '''
+    engine = engine or get_db_engine()
+    freshness = FreshnessPolicy(freshness_ttl)
+    rate_limiter.use_database(engine)
+    if deadline is not None:
+        await asyncio.to_thread(deadline.durations.load, engine, False)
+    reaper = asyncio.create_task(reap_periodically(engine))
+    notifier = None
+    if listen:
+        notifier = JobNotifier(engine)
+        notifier.start()
+    queue = JobQueue(
+        engine,
+        authenticated=False,
+        batch_size=batch_size or concurrency,
+        max_jobs=max_jobs,
+        notifier=notifier,
+        deadline=deadline,
+    )
 
     progress = Progress()
 
-    # TODO: this doesn't handle asyncio cancel.
-    # unauthenticated get_tweets pretends to be a generator (nice coroutine) but
-    # it uses a dependency which is actually greedy. This means asyncio cancels
-    # aren't handled immediately---the scrape job will run fully to completion
     async def worker(i: int):
         logger.debug(f'Starting unauthenticated worker {i}/{concurrency}')
         while True:
+            await throttle.wait()
+            job = await queue.get()
+            if job is None:
+                return
+
             with Session(engine) as session:
-                job = await take_job(session, authenticated=False)
-                scraper = UnauthenticatedScraper(job.username)
-                await asyncio.to_thread(scrape, session, scraper, job)
+                scraper = AsyncUnauthenticatedScraper(job.username)
+                started = time.monotonic()
+                await scrape(session, scraper, job, freshness)
+                if deadline is not None:
+                    deadline.durations.add(time.monotonic() - started)
                 await progress.push(job.username)
 
-            if max_jobs is not None and await progress.progress() >= max_jobs:
-                return
-
             if cooldown is not None:
                 await asyncio.sleep(cooldown)
 
-    await asyncio.gather(*[
+    workers = asyncio.gather(*[
         worker(i + 1) for i in range(concurrency)
     ])
+    try:
+        if deadline is None:
+            await workers
+        else:
+            # running jobs are cancelled, which saves what they scraped so far
+            # and requeues them
+            await asyncio.wait_for(workers, deadline.remaining())
+    except asyncio.TimeoutError:
+        logger.warning('reached deadline, requeued running jobs')
+    finally:
+        reaper.cancel()
+        queue.release()
+        if notifier is not None:
+            notifier.close()
 
     return progress._usernames
@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, Dict, Optional, Type
+
+from sqlalchemy.orm import Session
+
+from common.logging import logger
+from models.job import Job, notify_new_jobs, save_checkpoint
+from models.upsert import row_key, upsert
+from runner.dedup import EnqueuedJobs, JobKey, enqueued_jobs
+from runner.frontier import PriorityScore, default_priority, enqueue_jobs
+from scrapers.checkpoint import Checkpoint
+
+
+# seconds between saving a job's checkpoint
+CHECKPOINT_INTERVAL = 30
+
+
+class BufferedWriter:
+    '''
+    Collects scraped rows and child jobs and writes them in batches: one
+    multi-row upsert per table and a single commit per flush, instead of a
+    merge and a commit per row.
+
+    A flush happens once `max_rows` rows are buffered or `max_interval`
+    seconds have passed since the last one, and when the writer is closed.
+    Used as an async context manager, flushes run in a thread and only happen
+    when the caller awaits `flush_if_needed`.
+    Child jobs are deduplicated (within the job and against `enqueued`),
+    scored by `priority` and inserted as one batch when the writer is closed,
+    within the crawl's account budget.
+    With a `checkpoint`, it's saved on `job` every CHECKPOINT_INTERVAL
+    seconds, in the same transaction as the rows and child jobs scraped up to
+    that point, so a resumed job can skip them.
+    Use as a context manager.
+    '''
+    _session: Session
+    _max_rows: int
+    _max_interval: float
+    _autoflush: bool
+    _enqueued: EnqueuedJobs
+    _rows: Dict[Type, Dict[Any, Any]]
+    _priority: PriorityScore
+    _jobs: Dict[JobKey, Job]
+    _n_edges: Dict[JobKey, int]
+    _job: Optional[Job]
+    _checkpoint: Optional[Checkpoint]
+    _n_buffered: int
+    _last_flush: float
+
+    def __init__(
+        self,
+        session: Session,
+        max_rows: int = 500,
+        max_interval: float = 5,
+        enqueued: EnqueuedJobs = enqueued_jobs,
+        priority: PriorityScore = default_priority,
+        job: Optional[Job] = None,
+        checkpoint: Optional[Checkpoint] = None,
+    ) -> None:
+        self._session = session
+        self._max_rows = max_rows
+        self._max_interval = max_interval
+        self._autoflush = True
+        self._enqueued = enqueued
+        self._rows = {}
+        self._priority = priority
+        self._jobs = {}
+        self._n_edges = {}
+        self._job = job
+        self._checkpoint = checkpoint
+        self._n_buffered = 0
+        self._last_flush = time.monotonic()
+
+    def add(self, *rows: Any):
+        '''Buffer scraped rows (accounts, tweets, follows...).'''
+        for row in rows:
+            # keyed so a row scraped twice in one batch doesn't hit the same
+            # key twice in one upsert (postgres refuses that)
+            self._rows.setdefault(type(row), {})[row_key(row)] = row
+            self._n_buffered += 1
+        self._maybe_flush()
+
+    def add_jobs(self, *jobs: Job):
+        '''Buffer child jobs, dropping ones that were already enqueued.'''
+        for job in jobs:
+            key = (job.job_id, job.username, job.is_authenticated)
+            # duplicates still count towards the job's priority
+            self._n_edges[key] = self._n_edges.get(key, 0) + 1
+            if key not in self._jobs and key not in self._enqueued:
+                self._jobs[key] = job
+
+    def needs_flush(self) -> bool:
+        return (
+            self._n_buffered >= self._max_rows
+            or time.monotonic() - self._last_flush >= self._max_interval
+        )
+
+    def _checkpoint_due(self) -> bool:
+        return self._checkpoint is not None and self._checkpoint.due(CHECKPOINT_INTERVAL)
+
+    def _maybe_flush(self):
+        if self._autoflush and self.needs_flush():
+            self.flush()
+
+    async def flush_if_needed(self):
+        if self.needs_flush():
+            await asyncio.to_thread(self.flush)
+
+    def flush(self, include_jobs: bool = False):
+        rows, self._rows = self._rows, {}
+        save_progress = self._checkpoint is not None and (include_jobs or self._checkpoint_due())
+        # a resumed job won't find child jobs of the part it skips again
+        include_jobs = include_jobs or save_progress
+        jobs = {}
+        if include_jobs:
+            jobs, self._jobs = self._jobs, {}
+            for key, job in jobs.items():
+                job.priority = self._priority(job, self._n_edges[key])
+            self._n_edges = {}
+        self._n_buffered = 0
+        self._last_flush = time.monotonic()
+
+        for model, batch in rows.items():
+            self._session.execute(upsert(model, *batch.values()))
+        if len(jobs) > 0:
+            enqueue_jobs(self._session, list(jobs.values()), self._max_rows)
+            notify_new_jobs(self._session)
+        if save_progress:
+            save_checkpoint(self._session, self._job, self._checkpoint.to_json())
+        self._session.commit()
+        self._enqueued.add(jobs.keys())
+        if save_progress:
+            self._checkpoint.saved()
+
+        logger.debug(
+            f'flushed {sum(len(batch) for batch in rows.values())} rows, {len(jobs)} jobs')
+
+    def __enter__(self) -> BufferedWriter:
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.flush(include_jobs=True)
+            return
+
+        # still save what was scraped before the error, but don't let a failed
+        # flush hide the original exception
+        try:
+            self.flush(include_jobs=True)
+        except Exception as e:
+            logger.warning(f'could not save buffered rows: {e}')
+            self._session.rollback()
+
+    async def __aenter__(self) -> BufferedWriter:
+        self._autoflush = False
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await asyncio.to_thread(self.__exit__, exc_type, exc, traceback)
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Generator
+from typing import Generator, Optional
 
 from models.account import Account
 from models.interaction import Tweet
@@ -23,7 +23,8 @@ class Scraper(ABC):
         pass
 
     @abstractmethod
-    def get_tweets(self, include_replies: bool = True, max_tweets: int = 200) -> Generator[Tweet, None, None]:
+    def get_tweets(self, include_replies: bool = True, max_tweets: int = 200, since_id: Optional[str] = None) -> Generator[Tweet, None, None]:
+        '''Newest first. With `since_id`, may stop once older tweets are reached.'''
         yield from []
 
     @abstractmethod
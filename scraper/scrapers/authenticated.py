@@ -1,8 +1,10 @@
 from __future__ import annotations
 
-from typing import Optional, Generator
+import time
+from typing import List, Optional, Generator, Set, Tuple
 
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
 
 from models.account import Account
 from models.interaction import Tweet
@@ -11,23 +13,41 @@ from models.interaction import Follow
 from common.logging import logger
 from scrapers import exceptions
 from scrapers.abstract import Scraper
+from scrapers.checkpoint import Checkpoint
+from scrapers.ratelimit import BucketKey, account_key, egress_key, rate_limiter
 from scrapers.unauthenticated import UnauthenticatedScraper
 
 from vendor.scweet import utils
 from vendor.scweet.credentials import Credentials
-from vendor.scweet.utils import init_driver
+from vendor.scweet.utils import DEFAULT_JITTER, FollowedUser, NetworkUsage, init_driver
 
 
 def wrap_exceptions(func):
+    # only wraps generators: errors happen while iterating, not when called
     def wrapped(self: AuthenticatedScraper, *args, **kwargs):
         try:
-            return func(self, *args, **kwargs)
+            yield from func(self, *args, **kwargs)
+        except exceptions.ScraperException:
+            raise
+        except utils.RateLimitedResponse as e:
+            rate_limiter.penalize(*self._rate_limit_keys())
+            raise exceptions.RateLimited(self._username, e) from e
+        except (TimeoutException, WebDriverException) as e:
+            # slow page, crashed tab... also might have been logged out, check
+            # next time
+            self.logged_in = False
+            raise exceptions.TransientException(self._username, e) from e
         except Exception as e:
-            raise exceptions.UnknownException(self._username, e)
+            self.logged_in = False
+            raise exceptions.UnknownException(self._username, e) from e
 
     return wrapped
 
 
+def parse_rest_id(rest_id: Optional[str]) -> Optional[int]:
+    return int(rest_id) if rest_id is not None else None
+
+
 class AuthenticatedScraper(Scraper):
     _jobs_handled: int
     _credentials: Credentials
@@ -37,6 +57,19 @@ class AuthenticatedScraper(Scraper):
     _profile_dir: Optional[str]
     _proxy: Optional[str]
     _headless: bool
+    _jitter: Tuple[float, float]
+    _capture_network: bool
+    _lean: bool
+    _max_duration: Optional[float]
+    _started: float
+    # target's rest_id, if known, for follow edges
+    _rest_id: Optional[int]
+    # set once the driver is known to be logged in (e.g. by a previous job on
+    # a pooled driver) to skip checking
+    logged_in: bool
+    # what the browser loaded for this scraper (only counted with network
+    # capture)
+    network_usage: NetworkUsage
 
     def __init__(
         self,
@@ -48,8 +81,28 @@ class AuthenticatedScraper(Scraper):
         profile_dir: Optional[str] = None,
         proxy: Optional[str] = None,
         wait_time: int = 2,
+        logged_in: bool = False,
+        jitter: Tuple[float, float] = DEFAULT_JITTER,
+        capture_network: bool = False,
+        rest_id: Optional[int] = None,
+        lean: bool = False,
+        max_duration: Optional[float] = None,
     ):
+        '''
+        :wait_time max seconds to wait for a page to load
+        :jitter range of seconds to pause between browser actions
+        :capture_network read follows from the API responses the page loads
+            rather than the page itself. The driver must be started with
+            capture_network too.
+        :rest_id the target's rest_id, if known. Follows only get rest_ids on
+            both ends when this is set and network capture is on.
+        :lean start the driver with init_driver's lean profile (if it isn't
+            passed in)
+        :max_duration seconds after which the scrape stops (with a
+            TransientException) before its next request
+        '''
         self._jobs_handled = 0
+        self.logged_in = logged_in
         self._credentials = credentials
         self._unauthenticated = None
         self._driver = driver
@@ -57,6 +110,13 @@ class AuthenticatedScraper(Scraper):
         self._profile_dir = profile_dir
         self._headless = headless or False
         self._proxy = proxy
+        self._jitter = jitter
+        self._capture_network = capture_network
+        self._rest_id = rest_id
+        self._lean = lean
+        self._max_duration = max_duration
+        self._started = time.monotonic()
+        self.network_usage = NetworkUsage()
         super().__init__(username, wait_time)
 
     def id(self) -> str:
@@ -71,10 +131,21 @@ class AuthenticatedScraper(Scraper):
                 headless=self._headless,
                 profile_dir=self._profile_dir,
                 user_data_dir=self._user_data_dir,
-                proxy=self._proxy
+                proxy=self._proxy,
+                capture_network=self._capture_network,
+                lean=self._lean,
             )
         return self._driver
 
+    def _rate_limit_keys(self) -> List[BucketKey]:
+        return [account_key(self._credentials.username), egress_key(self._proxy)]
+
+    def _throttle(self):
+        if self._max_duration is not None and time.monotonic() - self._started > self._max_duration:
+            raise exceptions.TransientException(
+                self._username, f'ran for over {self._max_duration}s')
+        rate_limiter.wait(*self._rate_limit_keys())
+
     def _get_unauthenticated_scraper(self, username: str) -> UnauthenticatedScraper:
         if self._unauthenticated is None or self._unauthenticated._username != username:
             self._unauthenticated = UnauthenticatedScraper(username)
@@ -87,38 +158,97 @@ class AuthenticatedScraper(Scraper):
     def get_tweets(self, *args, **kwargs) -> Generator[Tweet, None, None]:
         return self._get_unauthenticated_scraper(self._username).get_tweets(*args, **kwargs)
 
+    def _get_follow(self, follow: utils.FollowList, limit: int, seen: Optional[Set[str]] = None) -> Generator[FollowedUser, None, None]:
+        if self._capture_network:
+            users = utils.get_follow_captured(
+                self._get_driver(),
+                self._username,
+                credentials=self._credentials,
+                follow=follow,
+                wait=self._wait_time,
+                limit=limit,
+                check_login=not self.logged_in,
+                jitter=self._jitter,
+                throttle=self._throttle,
+                usage=self.network_usage,
+                seen=seen,
+            )
+        else:
+            users = (FollowedUser(username) for username in utils.get_follow(
+                self._get_driver(),
+                self._username,
+                headless=False,
+                credentials=self._credentials,
+                follow=follow,
+                verbose=True,
+                wait=self._wait_time,
+                limit=limit,
+                check_login=not self.logged_in,
+                jitter=self._jitter,
+                throttle=self._throttle,
+                seen=seen,
+            ))
+        for user in users:
+            self.logged_in = True
+            yield user
+
+    def _follow(self, follow: utils.FollowList, user: FollowedUser) -> Follow:
+        if follow == 'following':
+            return Follow(
+                follows_username=user.username,
+                followed_by_username=self._username,
+                follows_rest_id=parse_rest_id(user.rest_id),
+                followed_by_rest_id=self._rest_id,
+            )
+        return Follow(
+            follows_username=self._username,
+            followed_by_username=user.username,
+            follows_rest_id=self._rest_id,
+            followed_by_rest_id=parse_rest_id(user.rest_id),
+        )
+
     @wrap_exceptions
     def get_following(self, limit: int = 200) -> Generator[Follow, None, None]:
-        following = utils.get_follow(
-            self._get_driver(),
-            self._username,
-            headless=False,
-            credentials=self._credentials,
-            follow='following',
-            verbose=True,
-            wait=self._wait_time,
-            limit=limit
-        )
-        for username in following:
-            yield Follow(
-                follows_username=username,
-                followed_by_username=self._username
-            )
+        for user in self._get_follow('following', limit):
+            yield self._follow('following', user)
 
     @wrap_exceptions
     def get_followers(self, limit: int = 200) -> Generator[Follow, None, None]:
-        followers = utils.get_follow(
+        for user in self._get_follow('followers', limit):
+            yield self._follow('followers', user)
+
+    @wrap_exceptions
+    def get_follows(self, max_following: int = 200, max_followers: int = 200, checkpoint: Optional[Checkpoint] = None) -> Generator[Tuple[utils.FollowList, Follow], None, None]:
+        '''
+        Following and followers, with the list each came from. With network
+        capture, both lists are crawled at once in two windows of the driver.
+        With a `checkpoint`, users it has seen are skipped and users yielded
+        are added to it.
+        '''
+        checkpoint = checkpoint or Checkpoint()
+        seen = {
+            'following': checkpoint.seen('following'),
+            'followers': checkpoint.seen('followers'),
+        }
+        if not self._capture_network:
+            for user in self._get_follow('following', max_following, seen['following']):
+                yield 'following', self._follow('following', user)
+            for user in self._get_follow('followers', max_followers, seen['followers']):
+                yield 'followers', self._follow('followers', user)
+            return
+
+        users = utils.get_follows_captured(
             self._get_driver(),
             self._username,
-            headless=False,
             credentials=self._credentials,
-            follow='followers',
-            verbose=True,
+            limits={'following': max_following, 'followers': max_followers},
             wait=self._wait_time,
-            limit=limit
+            check_login=not self.logged_in,
+            jitter=self._jitter,
+            throttle=self._throttle,
+            usage=self.network_usage,
+            seen=seen,
         )
-        for username in followers:
-            yield Follow(
-                follows_username=self._username,
-                followed_by_username=username
-            )
+        for follow, user in users:
+            self.logged_in = True
+            yield follow, self._follow(follow, user)
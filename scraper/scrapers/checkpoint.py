@@ -0,0 +1,45 @@
+'''
+How far a job got, so an interrupted job (timeout, crash, rate limit) resumes
+where it left off instead of starting over. Scrapers update the checkpoint as
+they go, and the runner saves it on the job row in the same transaction as
+everything scraped up to that point (see runner.writer.BufferedWriter).
+'''
+import time
+from typing import Any, Dict, Optional, Set
+
+
+class Checkpoint:
+    '''
+    JSON-able progress of a job. Only update it once everything before that
+    point has been handed to the writer, or a resumed job skips it.
+    '''
+    state: Dict[str, Any]
+    _last_saved: float
+
+    def __init__(self, state: Optional[Dict[str, Any]] = None) -> None:
+        self.state = dict(state or {})
+        self._last_saved = time.monotonic()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.state.get(key, default)
+
+    def set(self, **values: Any):
+        self.state.update(values)
+
+    def seen(self, key: str) -> Set[str]:
+        '''A set kept in the checkpoint, updated in place by the scraper.'''
+        seen = set(self.state.get(key, []))
+        self.state[key] = seen
+        return seen
+
+    def due(self, interval: float) -> bool:
+        return time.monotonic() - self._last_saved >= interval
+
+    def saved(self):
+        self._last_saved = time.monotonic()
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            key: sorted(value) if isinstance(value, set) else value
+            for key, value in self.state.items()
+        }
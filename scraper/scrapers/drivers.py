@@ -0,0 +1,140 @@
+'''
+Warm, logged in browsers for authenticated scrapers, kept across jobs.
+'''
+from __future__ import annotations
+
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from selenium import webdriver
+
+from common.logging import logger
+from common.process import process_tree_rss
+from vendor.scweet.utils import NetworkUsage
+
+
+class PooledDriver:
+    driver: webdriver.Remote
+    n_jobs: int
+    # whether this browser has been seen logged in, so jobs can skip the check
+    logged_in: bool
+
+    def __init__(self, driver: webdriver.Remote) -> None:
+        self.driver = driver
+        self.n_jobs = 0
+        self.logged_in = False
+
+    def healthy(self) -> bool:
+        try:
+            self.driver.execute_script('return 1;')
+            return True
+        except Exception:
+            return False
+
+    def rss(self) -> Optional[int]:
+        try:
+            return process_tree_rss(self.driver.service.process.pid)
+        except AttributeError:
+            # remote driver, no local process to measure
+            return None
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception as e:
+            logger.warning(f'chrome: error while quitting driver: {e}')
+
+
+class DriverPool:
+    '''
+    One browser per worker account, reused for as long as it stays healthy.
+    Browsers are recycled after `max_jobs` jobs or once chrome uses more than
+    `max_rss` bytes, so long runs don't accumulate leaks. At most `max_size`
+    browsers are kept: workers rotate through accounts, so the least recently
+    used idle one (e.g. its account is resting) is closed to make room.
+    '''
+    _max_size: Optional[int]
+    _max_jobs: int
+    _max_rss: int
+    # least recently used first
+    _drivers: Dict[str, PooledDriver]
+    # handed out by get and not released yet
+    _in_use: Set[str]
+    _lock: threading.Lock
+
+    def __init__(self, max_size: Optional[int] = None, max_jobs: int = 50, max_rss: int = 1500 * 1024 * 1024) -> None:
+        self._max_size = max_size
+        self._max_jobs = max_jobs
+        self._max_rss = max_rss
+        self._drivers = {}
+        self._in_use = set()
+        self._lock = threading.Lock()
+
+    def _evict_idle(self, n_kept: int) -> List[Tuple[str, PooledDriver]]:
+        '''
+        Take out the least recently used drivers not in use until at most
+        `n_kept` are left (or only ones in use). Caller must hold the lock.
+        '''
+        evicted = []
+        for key in list(self._drivers):
+            if len(self._drivers) <= n_kept:
+                break
+            if key not in self._in_use:
+                evicted.append((key, self._drivers.pop(key)))
+        return evicted
+
+    def get(self, key: str, create: Callable[[], webdriver.Remote]) -> PooledDriver:
+        with self._lock:
+            pooled = self._drivers.pop(key, None)
+            self._in_use.add(key)
+            evicted = []
+            if self._max_size is not None:
+                # make room for this one
+                evicted = self._evict_idle(self._max_size - 1)
+
+        for evicted_key, evicted_driver in evicted:
+            logger.info(f'chrome: closing idle driver for {evicted_key} to make room')
+            evicted_driver.quit()
+
+        if pooled is not None and not pooled.healthy():
+            logger.warning(f'chrome: driver for {key} is unresponsive, restarting')
+            pooled.quit()
+            pooled = None
+
+        if pooled is None:
+            logger.debug(f'chrome: launching driver for {key}')
+            pooled = PooledDriver(create())
+
+        with self._lock:
+            # most recently used last
+            self._drivers[key] = pooled
+        return pooled
+
+    def release(self, key: str, usage: Optional[NetworkUsage] = None):
+        '''
+        Call when a job using the driver is done, with what the job loaded to
+        report it along with chrome's memory use.
+        '''
+        with self._lock:
+            self._in_use.discard(key)
+            pooled = self._drivers.get(key)
+        if pooled is None:
+            return
+
+        pooled.n_jobs += 1
+        rss = pooled.rss()
+        if usage is not None:
+            logger.info(f'chrome: job on {key} loaded {usage}, chrome using {rss} bytes')
+        if pooled.n_jobs >= self._max_jobs or (rss is not None and rss > self._max_rss):
+            logger.info(
+                f'chrome: recycling driver for {key} after {pooled.n_jobs} jobs ({rss} bytes)')
+            with self._lock:
+                self._drivers.pop(key, None)
+            pooled.quit()
+
+    def quit_all(self):
+        with self._lock:
+            drivers, self._drivers = self._drivers, {}
+            self._in_use = set()
+        for pooled in drivers.values():
+            pooled.quit()
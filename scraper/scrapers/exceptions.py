@@ -9,11 +9,34 @@ class ScraperException(Exception):
         super().__init__(*args)
 
 
-class UserNotFound(ScraperException):
+class PermanentException(ScraperException):
+    '''Retrying won't help.'''
     pass
 
 
-class UserProtected(ScraperException):
+class TransientException(ScraperException):
+    '''Might work if tried again later (network errors, timeouts...).'''
+    info: Optional[Any]
+
+    def __init__(self, username: str, info: Optional[Any], *args: object) -> None:
+        self.info = info
+        super().__init__(username, *args)
+
+
+class RateLimited(TransientException):
+    # seconds until the limit resets, if known
+    retry_after: Optional[float]
+
+    def __init__(self, username: str, info: Optional[Any], retry_after: Optional[float] = None, *args: object) -> None:
+        self.retry_after = retry_after
+        super().__init__(username, info, *args)
+
+
+class UserNotFound(PermanentException):
+    pass
+
+
+class UserProtected(PermanentException):
     pass
 
 
@@ -23,6 +46,3 @@ class UnknownException(ScraperException):
     def __init__(self, username: str, info: Optional[Any], *args: object) -> None:
         self.info = info
         super().__init__(username, *args)
-
-
-# TODO: fill this out
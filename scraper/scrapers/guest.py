@@ -0,0 +1,140 @@
+'''
+Process-wide pool of tweety guest sessions.
+
+Constructing a tweety `Twitter` bot activates a new guest token and opens a
+new HTTP connection pool, which used to happen for every job. Instead, bots
+are built on top of pooled sessions, so jobs share guest tokens and keep-alive
+connections, and a session is only replaced once it has used up its request
+budget, been rate limited, or its token is about to expire.
+'''
+from __future__ import annotations
+
+import itertools
+import threading
+import time
+from typing import List, Optional
+
+from requests import Response
+from tweety.bot import Twitter as Bot
+from tweety.http import Request
+
+from common.logging import logger
+from scrapers.ratelimit import BucketKey, egress_key, guest_key, rate_limiter
+
+
+# guest tokens are handed out with a 3 hour max age
+MAX_SESSION_AGE = 60 * 60 * 2.5
+
+
+def proxy_egress_key(proxy: Optional[dict]) -> BucketKey:
+    # tweety proxies are requests-style {'http': ..., 'https': ...}
+    return egress_key(proxy and (proxy.get('https') or proxy.get('http')))
+
+
+class GuestSession:
+    id: int
+    request: Request
+    created_at: float
+    n_requests: int
+    rate_limited: bool
+    egress: BucketKey
+
+    def __init__(self, id: int, proxy: Optional[dict] = None) -> None:
+        self.id = id
+        self.egress = proxy_egress_key(proxy)
+        # activating the guest token is a request too
+        rate_limiter.wait(self.egress)
+        self.request = Request(None, proxy=proxy)
+        self.created_at = time.monotonic()
+        self.n_requests = 0
+        self.rate_limited = False
+        # tweety keeps its requests session private, but it's the only place
+        # to see status codes and rate limit headers
+        self.request._Request__session.hooks['response'].append(
+            self._on_response)
+
+    def _on_response(self, response: Response, *args, **kwargs):
+        self.n_requests += 1
+        if response.status_code == 429:
+            rate_limiter.penalize(*self.rate_limit_keys())
+        if response.status_code == 429 or response.headers.get('x-rate-limit-remaining') == '0':
+            logger.warning(f'guest session {self.id} is rate limited')
+            self.rate_limited = True
+
+    def rate_limit_keys(self) -> List[BucketKey]:
+        '''Rate limits every request on this session counts against.'''
+        return [guest_key(self.id), self.egress]
+
+    def usable(self, max_requests: int) -> bool:
+        return (
+            not self.rate_limited
+            and self.n_requests < max_requests
+            and time.monotonic() - self.created_at < MAX_SESSION_AGE
+        )
+
+
+class GuestSessionPool:
+    '''
+    Up to `size` guest sessions, handed out round robin. Sessions are shared
+    by concurrent jobs (it's a requests session underneath, which handles
+    that), and retired after `max_requests` requests.
+    '''
+    _size: int
+    _max_requests: int
+    _proxy: Optional[dict]
+    _sessions: List[GuestSession]
+    _ids: itertools.count
+    _next: int
+    _n_pending: int
+    _lock: threading.Lock
+
+    def __init__(self, size: int = 4, max_requests: int = 150, proxy: Optional[dict] = None) -> None:
+        self._size = size
+        self._max_requests = max_requests
+        self._proxy = proxy
+        self._sessions = []
+        self._ids = itertools.count()
+        self._next = 0
+        self._n_pending = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> GuestSession:
+        with self._lock:
+            for session in [s for s in self._sessions if not s.usable(self._max_requests)]:
+                logger.debug(
+                    f'retiring guest session {session.id} after {session.n_requests} requests')
+                self._sessions.remove(session)
+
+            # grow one session at a time, others use what's already there
+            growing = len(self._sessions) < self._size and self._n_pending == 0
+            if not growing and len(self._sessions) > 0:
+                self._next += 1
+                return self._sessions[self._next % len(self._sessions)]
+            self._n_pending += 1
+
+        try:
+            session = GuestSession(next(self._ids), proxy=self._proxy)
+            logger.debug(f'activated guest session {session.id}')
+        finally:
+            with self._lock:
+                self._n_pending -= 1
+
+        with self._lock:
+            self._sessions.append(session)
+        return session
+
+    def bot(self, username: str) -> Bot:
+        '''A tweety bot for `username` on a pooled guest session.'''
+        # skip Bot.__init__, which would activate a new guest token
+        bot = Bot.__new__(Bot)
+        bot.profile_url = f'https://twitter.com/{username}'
+        bot.proxy = self._proxy
+        # kept on the bot to tell when its errors were down to rate limiting
+        bot.guest_session = self.acquire()
+        bot.request = bot.guest_session.request
+        rate_limiter.wait(*bot.guest_session.rate_limit_keys())
+        bot.user = bot.get_user_info()
+        return bot
+
+
+guest_sessions = GuestSessionPool()
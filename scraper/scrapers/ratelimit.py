@@ -0,0 +1,195 @@
+'''
+Rate limiting shared by all workers, so adding workers (or lambdas) spreads
+the same request budget thinner instead of multiplying the request rate.
+
+Requests draw from token buckets: one per guest token, per worker account and
+per egress IP (proxy). Buckets of guest tokens, which are never shared between
+processes, live in memory. The others live in postgres once the runner calls
+`rate_limiter.use_database`, and in memory until then.
+
+Bucket rates adapt AIMD style: each request nudges the rate up a little, and
+every rate limited response halves it.
+'''
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from sqlalchemy import Engine, func, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from common.logging import logger
+from models.ratelimit import RateLimitBucket
+
+
+class BucketConfig(NamedTuple):
+    # tokens per second to start at
+    rate: float
+    # max burst
+    capacity: float
+    min_rate: float
+    max_rate: float
+
+
+BUCKETS: Dict[str, BucketConfig] = {
+    'guest': BucketConfig(rate=0.2, capacity=10, min_rate=0.01, max_rate=1),
+    'account': BucketConfig(rate=0.1, capacity=5, min_rate=0.005, max_rate=0.5),
+    'egress': BucketConfig(rate=2, capacity=20, min_rate=0.1, max_rate=20),
+}
+
+# requests per second gained per second of requests going through
+ADDITIVE_INCREASE = 0.001
+MULTIPLICATIVE_DECREASE = 0.5
+
+# (kind, name), kind being one of BUCKETS
+BucketKey = Tuple[str, str]
+
+
+def guest_key(guest_session_id: int) -> BucketKey:
+    return ('guest', str(guest_session_id))
+
+
+def account_key(username: str) -> BucketKey:
+    return ('account', username)
+
+
+def egress_key(proxy: Optional[str] = None) -> BucketKey:
+    '''
+    Requests through the same proxy share an IP. Without one, set
+    SCRAPER_EGRESS_ID to tell apart processes with different IPs, otherwise
+    they're assumed to share one (e.g. lambdas behind a NAT gateway).
+    '''
+    return ('egress', proxy or os.environ.get('SCRAPER_EGRESS_ID', 'default'))
+
+
+class LocalBuckets:
+    _buckets: Dict[str, Tuple[float, float, float]]
+    _lock: threading.Lock
+
+    def __init__(self) -> None:
+        # key -> (tokens, rate, updated at)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key: str, config: BucketConfig) -> float:
+        with self._lock:
+            now = time.monotonic()
+            tokens, rate, updated_at = self._buckets.get(
+                key, (config.capacity, config.rate, now))
+            tokens = min(config.capacity, tokens + rate * (now - updated_at)) - 1
+            rate = min(config.max_rate, rate + ADDITIVE_INCREASE / rate)
+            self._buckets[key] = (tokens, rate, now)
+        return max(0, -tokens / rate)
+
+    def penalize(self, key: str, config: BucketConfig):
+        with self._lock:
+            now = time.monotonic()
+            tokens, rate, _ = self._buckets.get(
+                key, (config.capacity, config.rate, now))
+            self._buckets[key] = (
+                min(tokens, 0),
+                max(config.min_rate, rate * MULTIPLICATIVE_DECREASE),
+                now,
+            )
+
+
+class DatabaseBuckets:
+    _engine: Engine
+
+    def __init__(self, engine: Engine) -> None:
+        self._engine = engine
+
+    def reserve(self, key: str, config: BucketConfig) -> float:
+        bucket = RateLimitBucket.__table__
+        elapsed = func.extract('epoch', func.now() - bucket.c.updated_at)
+        stmt = pg_insert(bucket).values(
+            key=key, tokens=config.capacity - 1, rate=config.rate)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[bucket.c.key],
+            set_=dict(
+                tokens=func.least(
+                    config.capacity, bucket.c.tokens + bucket.c.rate * elapsed) - 1,
+                rate=func.least(
+                    config.max_rate, bucket.c.rate + ADDITIVE_INCREASE / bucket.c.rate),
+                updated_at=func.now(),
+            ),
+        ).returning(bucket.c.tokens, bucket.c.rate)
+
+        with Session(self._engine) as session:
+            tokens, rate = session.execute(stmt).one()
+            session.commit()
+        return max(0, -tokens / rate)
+
+    def penalize(self, key: str, config: BucketConfig):
+        with Session(self._engine) as session:
+            session.execute(
+                update(RateLimitBucket)
+                .values(
+                    tokens=func.least(RateLimitBucket.tokens, 0),
+                    rate=func.greatest(
+                        config.min_rate, RateLimitBucket.rate * MULTIPLICATIVE_DECREASE),
+                    updated_at=func.now(),
+                )
+                .where(RateLimitBucket.key == key)
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+
+
+class RateLimiter:
+    _local: LocalBuckets
+    _shared: LocalBuckets | DatabaseBuckets
+
+    def __init__(self) -> None:
+        self._local = LocalBuckets()
+        self._shared = self._local
+
+    def use_database(self, engine: Engine):
+        '''
+        Share buckets (other than guest tokens') with other processes, unless
+        SCRAPER_LOCAL_RATE_LIMITS is set.
+        '''
+        if not os.environ.get('SCRAPER_LOCAL_RATE_LIMITS'):
+            self._shared = DatabaseBuckets(engine)
+
+    def _buckets(self, kind: str) -> LocalBuckets | DatabaseBuckets:
+        return self._local if kind == 'guest' else self._shared
+
+    def _reserve(self, kind: str, name: str) -> float:
+        key = f'{kind}:{name}'
+        try:
+            return self._buckets(kind).reserve(key, BUCKETS[kind])
+        except Exception as e:
+            # don't fail requests over it, but still pace this process
+            logger.warning(f'could not check shared rate limit for {key}: {e}')
+            return self._local.reserve(key, BUCKETS[kind])
+
+    def reserve(self, *keys: BucketKey) -> float:
+        '''Take a token from each bucket. Returns how long to wait before the request.'''
+        return max(self._reserve(kind, name) for kind, name in keys)
+
+    def wait(self, *keys: BucketKey):
+        delay = self.reserve(*keys)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self, *keys: BucketKey):
+        delay = await asyncio.to_thread(self.reserve, *keys)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def penalize(self, *keys: BucketKey):
+        '''Slow down after a rate limited response.'''
+        for kind, name in keys:
+            logger.warning(f'rate limited, slowing down {kind}:{name}')
+            try:
+                self._buckets(kind).penalize(f'{kind}:{name}', BUCKETS[kind])
+            except Exception as e:
+                logger.warning(f'could not update rate limit for {kind}:{name}: {e}')
+
+
+rate_limiter = RateLimiter()
@@ -1,11 +1,14 @@
 from __future__ import annotations
 
+import asyncio
 import time
 from math import ceil
-from typing import Generator, Optional
+from typing import AsyncGenerator, Generator, List, Optional, Set
 
+from requests import RequestException
 from tweety import exceptions_ as tw_exceptions
 from tweety.bot import Twitter as Bot
+from tweety.types.twDataTypes import User as TwUser
 from tweety.types.usertweet import Tweet as TwTweet
 
 from models.account import Account
@@ -13,32 +16,187 @@ from models.interaction import Tweet
 from models.interaction import Follow
 from scrapers import exceptions
 from scrapers.abstract import Scraper
+from scrapers.checkpoint import Checkpoint
+from scrapers.guest import guest_sessions
+from scrapers.ratelimit import rate_limiter
+
+
+# twitter API error codes
+RATE_LIMIT_EXCEEDED = 88
+
+# pages fetched ahead of the ones being saved
+PREFETCH_PAGES = 2
+
+
+def translate_exception(username: str, e: Exception, rate_limited: bool = False) -> Exception:
+    '''
+    :rate_limited the guest session saw a rate limited response, which tweety
+        doesn't always report as such
+    '''
+    if isinstance(e, exceptions.ScraperException):
+        return e
+    if isinstance(e, tw_exceptions.UserNotFound):
+        return exceptions.UserNotFound(username)
+    if isinstance(e, tw_exceptions.UserProtected):
+        return exceptions.UserProtected(username)
+    if rate_limited or getattr(e, 'error_code', None) == RATE_LIMIT_EXCEEDED:
+        return exceptions.RateLimited(username, e)
+    if isinstance(e, (tw_exceptions.GuestTokenNotFound, RequestException)):
+        return exceptions.TransientException(username, e)
+    if isinstance(e, tw_exceptions.UnknownError):
+        return exceptions.UnknownException(username, e.message)
+    return e
 
 
 def wrap_exceptions(func):
     def wrapped(self: UnauthenticatedScraper, *args, **kwargs):
         try:
             return func(self, *args, **kwargs)
-        except tw_exceptions.UserNotFound:
-            raise exceptions.UserNotFound(self._username)
-        except tw_exceptions.UserProtected:
-            print('WTF?')
-            raise exceptions.UserProtected(self._username)
-        except tw_exceptions.UnknownError as e:
-            raise exceptions.UnknownException(self._username, e.message)
+        except Exception as e:
+            translated = translate_exception(
+                self._username, e, self._rate_limited())
+            if translated is e:
+                raise
+            raise translated from e
 
     return wrapped
 
 
-def as_generator(bot: Bot, pages: int, get_replies: bool, wait_time: int) -> Generator[TwTweet, None, None]:
-    fetcher = bot.get_tweets(0)
+def caught_up(tweets: List[TwTweet], since_id: Optional[str], pinned: Set[str], author_rest_id: str) -> bool:
+    '''
+    Whether a page reached the target's own tweets at or below `since_id`
+    (ones we already have).
+    '''
+    # pinned tweets can be old and show up first, and replies come with the
+    # (older) tweets they reply to. Neither means we're caught up
+    return since_id is not None and any(
+        int(tweet.id) <= int(since_id)
+        for tweet in tweets
+        if tweet.id not in pinned and str(tweet.author.rest_id) == author_rest_id
+    )
+
+
+def page_reached(fetcher, page: int, checkpoint: Checkpoint):
+    '''Record that every tweet up to `page` was handled.'''
+    checkpoint.set(tweets_cursor=fetcher.cursor, tweets_pages=page)
 
-    for page in range(1, pages + 1):
-        yield from fetcher.get_next_page(user_id=fetcher.user_id, get_replies=get_replies)
+
+def as_generator(bot: Bot, pages: int, get_replies: bool, wait_time: int, since_id: Optional[str] = None, checkpoint: Optional[Checkpoint] = None) -> Generator[TwTweet, None, None]:
+    '''
+    Yield tweets page by page. With `since_id`, stop after the first page that
+    reaches tweets we already have. With a `checkpoint`, start after the last
+    page it reached and record each page reached.
+    '''
+    checkpoint = checkpoint or Checkpoint()
+    fetcher = bot.get_tweets(0, cursor=checkpoint.get('tweets_cursor'))
+    pinned = set(bot.user.pinned_tweets or [])
+
+    for page in range(checkpoint.get('tweets_pages', 0) + 1, pages + 1):
+        rate_limiter.wait(*bot.guest_session.rate_limit_keys())
+        tweets = fetcher.get_next_page(
+            user_id=fetcher.user_id, get_replies=get_replies) or []
+        yield from tweets
+        page_reached(fetcher, page, checkpoint)
+        if caught_up(tweets, since_id, pinned, str(bot.user.rest_id)):
+            return
         if fetcher.is_next_page and page != pages:
             time.sleep(wait_time)
 
 
+async def fetch_pages(bot: Bot, pages: int, get_replies: bool, wait_time: int, since_id: Optional[str], checkpoint: Checkpoint, queue: asyncio.Queue):
+    '''
+    Put (page, cursor after it, tweets) on `queue` for every page, then None.
+    An exception is put on the queue instead of raised.
+    '''
+    try:
+        fetcher = await asyncio.to_thread(
+            bot.get_tweets, 0, cursor=checkpoint.get('tweets_cursor'))
+        pinned = set(bot.user.pinned_tweets or [])
+
+        for page in range(checkpoint.get('tweets_pages', 0) + 1, pages + 1):
+            await rate_limiter.wait_async(*bot.guest_session.rate_limit_keys())
+            tweets = await asyncio.to_thread(
+                fetcher.get_next_page, user_id=fetcher.user_id, get_replies=get_replies) or []
+            await queue.put((page, fetcher.cursor, tweets))
+            if caught_up(tweets, since_id, pinned, str(bot.user.rest_id)):
+                break
+            if fetcher.is_next_page and page != pages:
+                await asyncio.sleep(wait_time)
+    except Exception as e:
+        await queue.put(e)
+        return
+    await queue.put(None)
+
+
+async def as_async_generator(bot: Bot, pages: int, get_replies: bool, wait_time: int, since_id: Optional[str] = None, checkpoint: Optional[Checkpoint] = None) -> AsyncGenerator[TwTweet, None]:
+    '''
+    Same as `as_generator`, but each request runs in a thread of its own and
+    waits between pages don't block, so the task can be cancelled between
+    requests and only holds a thread while a request is in flight.
+
+    Pages are fetched by a separate task, up to PREFETCH_PAGES ahead, so the
+    next request and the wait before it overlap with saving the tweets
+    already yielded. A page only counts as reached in the checkpoint once all
+    its tweets have been yielded.
+    '''
+    checkpoint = checkpoint or Checkpoint()
+    queue = asyncio.Queue(maxsize=PREFETCH_PAGES)
+    fetcher = asyncio.create_task(fetch_pages(
+        bot, pages, get_replies, wait_time, since_id, checkpoint, queue))
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            page, cursor, tweets = item
+            for tweet in tweets:
+                yield tweet
+            checkpoint.set(tweets_cursor=cursor, tweets_pages=page)
+    finally:
+        fetcher.cancel()
+
+
+def to_account(user_info: TwUser) -> Account:
+    return Account(
+        profile_url=user_info.profile_url,
+        rest_id=user_info.rest_id,
+        display_name=user_info.name,
+        username=user_info.screen_name,
+        joined_at=user_info.created_at,
+        description=user_info.description,
+        location=user_info.location,
+        protected=user_info.protected,
+        verified=user_info.verified,
+        followers_count=user_info.followers_count,
+        following_count=user_info.friends_count,
+        statuses_count=user_info.statuses_count,
+        favourites_count=user_info.fast_followers_count,
+    )
+
+
+def to_tweet(_tweet: TwTweet) -> Tweet:
+    raw: dict = _tweet._get_original_tweet()
+    return Tweet(
+        rest_id=_tweet.id,
+        created_on=_tweet.created_on,
+        content=_tweet.text,
+        author_rest_id=_tweet.author.rest_id,
+        reply_count=_tweet.reply_counts,  # yes, it is plural from API
+        like_count=_tweet.likes,
+        retweet_count=_tweet.retweet_counts,
+        quote_count=_tweet.quote_counts,
+        is_retweet=_tweet.is_retweet,
+        is_reply=_tweet.is_reply,
+        reply_to_account_username=_tweet.reply_to,
+        reply_to_account_rest_id=raw.get(
+            'in_reply_to_user_id_str', None),
+        reply_to_tweet_rest_id=raw.get(
+            'in_reply_to_status_id_str', None),
+    )
+
+
 class UnauthenticatedScraper(Scraper):
     '''
     An unauthenticated scraper which can get public tweets + replies but not
@@ -55,56 +213,28 @@ class UnauthenticatedScraper(Scraper):
     def id(self) -> str:
         return f'anonymous-scraper:{self._username}'
 
+    def _rate_limited(self) -> bool:
+        return self._bot is not None and self._bot.guest_session.rate_limited
+
     # wtf why is this necessary LOL
     @wrap_exceptions
     def _get_bot(self, username: str) -> Bot:
-        if self._bot is None or self._bot.user.name != username:
-            self._bot = Bot(username)
+        if self._bot is None or self._bot.user.screen_name.lower() != username.lower():
+            self._bot = guest_sessions.bot(username)
 
         return self._bot
 
     @wrap_exceptions
     def get_user_info(self) -> Account:
-        user_info = self._get_bot(self._username).get_user_info()
-        return Account(
-            profile_url=user_info.profile_url,
-            rest_id=user_info.rest_id,
-            display_name=user_info.name,
-            username=user_info.screen_name,
-            joined_at=user_info.created_at,
-            description=user_info.description,
-            location=user_info.location,
-            protected=user_info.protected,
-            verified=user_info.verified,
-            followers_count=user_info.followers_count,
-            following_count=user_info.friends_count,
-            statuses_count=user_info.statuses_count,
-            favourites_count=user_info.fast_followers_count,
-        )
+        # already looked up when the bot was made
+        return to_account(self._get_bot(self._username).user)
 
     @wrap_exceptions
-    def get_tweets(self, include_replies: bool = True, max_tweets: int = 200) -> Generator[Tweet, None, None]:
+    def get_tweets(self, include_replies: bool = True, max_tweets: int = 200, since_id: Optional[str] = None, checkpoint: Optional[Checkpoint] = None) -> Generator[Tweet, None, None]:
         pages = max(ceil(max_tweets / 40), 1)
         tw = self._get_bot(self._username)
-        for _tweet in as_generator(tw, pages, include_replies, self._wait_time):
-            raw: dict = _tweet._get_original_tweet()
-            yield Tweet(
-                rest_id=_tweet.id,
-                created_on=_tweet.created_on,
-                content=_tweet.text,
-                author_rest_id=_tweet.author.rest_id,
-                reply_count=_tweet.reply_counts,  # yes, it is plural from API
-                like_count=_tweet.likes,
-                retweet_count=_tweet.retweet_counts,
-                quote_count=_tweet.quote_counts,
-                is_retweet=_tweet.is_retweet,
-                is_reply=_tweet.is_reply,
-                reply_to_account_username=_tweet.reply_to,
-                reply_to_account_rest_id=raw.get(
-                    'in_reply_to_user_id_str', None),
-                reply_to_tweet_rest_id=raw.get(
-                    'in_reply_to_status_id_str', None),
-            )
+        for _tweet in as_generator(tw, pages, include_replies, self._wait_time, since_id, checkpoint):
+            yield to_tweet(_tweet)
 
     @wrap_exceptions
     def get_following(self) -> Generator[Follow, None, None]:
@@ -113,3 +243,36 @@ class UnauthenticatedScraper(Scraper):
     @wrap_exceptions
     def get_followers(self) -> Generator[Follow, None, None]:
         return super().get_followers()
+
+
+class AsyncUnauthenticatedScraper:
+    '''
+    asyncio version of `UnauthenticatedScraper`, so one process can run many
+    more concurrent jobs than it has threads. tweety itself is blocking, so
+    every request still runs in a thread, but only for that one request.
+    '''
+
+    _scraper: UnauthenticatedScraper
+
+    def __init__(self, username: str, wait_time: int = 2):
+        self._scraper = UnauthenticatedScraper(username, wait_time)
+
+    def id(self) -> str:
+        return self._scraper.id()
+
+    async def get_user_info(self) -> Account:
+        return await asyncio.to_thread(self._scraper.get_user_info)
+
+    async def get_tweets(self, include_replies: bool = True, max_tweets: int = 200, since_id: Optional[str] = None, checkpoint: Optional[Checkpoint] = None) -> AsyncGenerator[Tweet, None]:
+        username = self._scraper._username
+        pages = max(ceil(max_tweets / 40), 1)
+        tw = await asyncio.to_thread(self._scraper._get_bot, username)
+        try:
+            async for _tweet in as_async_generator(tw, pages, include_replies, self._scraper._wait_time, since_id, checkpoint):
+                yield to_tweet(_tweet)
+        except Exception as e:
+            translated = translate_exception(
+                username, e, self._scraper._rate_limited())
+            if translated is e:
+                raise
+            raise translated from e
@@ -0,0 +1,95 @@
+import unittest
+from unittest import mock
+
+from models.interaction import Follow
+from models.job import Job, JobSource
+from runner.dedup import EnqueuedJobs
+from runner.writer import BufferedWriter
+from scrapers.checkpoint import Checkpoint
+
+
+def follow(username: str) -> Follow:
+    return Follow(follows_username=username, followed_by_username='target')
+
+
+def child_job(username: str) -> Job:
+    return Job(
+        job_id='target-1',
+        source=JobSource.FOLLOWING,
+        username=username,
+        own_depth=1,
+        max_depth=2,
+        max_tweets=10,
+        max_followers=10,
+        is_authenticated=True,
+    )
+
+
+class BufferedWriterFlushTest(unittest.TestCase):
+    def setUp(self):
+        self.session = mock.MagicMock()
+        # no crawl row, so no account budget
+        self.session.get.return_value = None
+        self.job = Job(internal_id=1, job_id='target-1', username='target')
+
+    def writer(self, checkpoint=None) -> BufferedWriter:
+        return BufferedWriter(
+            self.session,
+            enqueued=EnqueuedJobs(),
+            job=self.job,
+            checkpoint=checkpoint,
+        )
+
+    def statements(self):
+        return [str(call.args[0]) for call in self.session.execute.call_args_list]
+
+    def test_rows_only(self):
+        writer = self.writer()
+        writer.add(follow('a'))
+        writer.flush()
+        writer.flush(include_jobs=True)
+        self.assertEqual(self.session.commit.call_count, 2)
+        self.session.scalars.assert_not_called()
+
+    def test_child_jobs(self):
+        writer = self.writer()
+        writer.add(follow('a'))
+        writer.add_jobs(child_job('a'), child_job('b'))
+        writer.flush(include_jobs=True)
+        self.session.scalars.assert_called_once()
+        self.assertEqual(self.job.checkpoint, None)
+
+    def test_checkpoint_without_child_jobs(self):
+        checkpoint = Checkpoint()
+        checkpoint.set(tweets_pages=1)
+        writer = self.writer(checkpoint)
+        writer.add(follow('a'))
+        writer.flush(include_jobs=True)
+        self.assertTrue(any(s.startswith('UPDATE job SET checkpoint') for s in self.statements()))
+        self.assertEqual(self.job.checkpoint, {'tweets_pages': 1})
+        # still usable after saving
+        writer.add(follow('b'))
+        writer.flush()
+
+    def test_checkpoint_with_child_jobs(self):
+        checkpoint = Checkpoint()
+        checkpoint.seen('following').add('a')
+        writer = self.writer(checkpoint)
+        writer.add(follow('a'))
+        writer.add_jobs(child_job('a'))
+        writer.flush(include_jobs=True)
+        self.session.scalars.assert_called_once()
+        self.assertEqual(self.job.checkpoint, {'following': ['a']})
+
+    def test_checkpoint_not_due(self):
+        writer = self.writer(Checkpoint())
+        writer.add(follow('a'))
+        writer.add_jobs(child_job('a'))
+        writer.flush()
+        # neither the checkpoint nor the jobs it would have to cover
+        self.assertFalse(any(s.startswith('UPDATE job') for s in self.statements()))
+        self.session.scalars.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()